@@ -0,0 +1,83 @@
+"""
+Compare write/read throughput of PickleDict .pak codecs in disk mode against uncompressed files
+
+Usage: python benchmarks/bench_codecs.py [--dir DIR] [--repeat N] [--level LEVEL]
+(nodebook must be importable, e.g. after pip install -e .)
+
+Point --dir at the filesystem you care about (e.g. a shared NFS mount), since the tradeoff between CPU spent
+compressing and bytes written depends on it. The 'none' codec is the uncompressed format used before codecs.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from nodebook.pickledict import PickleDict, CODECS
+
+
+def sample_values():
+    """
+    Values that are stored as .pak files (arrays and Arrow-compatible frames use their own formats)
+    """
+    rng = np.random.RandomState(0)
+    n = 200000
+    return {
+        'records': [{'id': i, 'name': 'user_%d' % (i % 1000), 'score': float(i % 97)} for i in range(n)],
+        'mixed_frame': pd.DataFrame({
+            'key': [i if i % 2 else str(i) for i in range(n)],
+            'value': rng.normal(size=n),
+        }),
+        'noise': rng.bytes(16 * 1024 ** 2),
+    }
+
+
+def bench(codec, level, directory, values, repeat):
+    store = PickleDict(persist_path=directory, codec=codec, level=level)
+    write_time = read_time = 0.0
+    raw_bytes = stored_bytes = 0
+    for _ in range(repeat):
+        for name, value in values.items():
+            start = time.time()
+            store[name] = value
+            write_time += time.time() - start
+            stored_bytes += store.size(name)
+
+            start = time.time()
+            store[name]
+            read_time += time.time() - start
+    for name, value in values.items():
+        memory_store = PickleDict()
+        memory_store[name] = value
+        raw_bytes += memory_store.size(name) * repeat
+    return {
+        'codec': codec,
+        'ratio': float(stored_bytes) / raw_bytes,
+        'write_mb_s': raw_bytes / 1024 ** 2 / write_time,
+        'read_mb_s': raw_bytes / 1024 ** 2 / read_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help='directory to write to, defaults to a temporary directory')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--level', type=int, default=None, help='compression level, defaults per codec')
+    args = parser.parse_args()
+
+    values = sample_values()
+    print('%-6s %8s %12s %12s' % ('codec', 'ratio', 'write MB/s', 'read MB/s'))
+    for codec in sorted(CODECS):
+        directory = tempfile.mkdtemp(dir=args.dir)
+        try:
+            result = bench(codec, args.level, directory, values, args.repeat)
+        finally:
+            shutil.rmtree(directory)
+        print('%-6s %8.3f %12.1f %12.1f' % (result['codec'], result['ratio'], result['write_mb_s'],
+                                             result['read_mb_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Time the nodebook core hot paths, writing comparable JSON results
+
+Usage: python benchmarks/bench_core.py [--json FILE] [--compare BASELINE] [--repeat N] [--quick] [--dir DIR]
+(nodebook must be importable, e.g. after pip install -e .)
+
+Measures pickledict.hash and PickleDict get/set for scalars, dicts, large arrays and DataFrames in memory and disk
+mode, ReferenceFinder and compiling on large cells, and Nodebook.run_node, invalidation and output lookups on
+synthetic notebooks of 10 to 5000 cells. Each benchmark reports the best of --repeat timings, in seconds per
+operation. Save results from a known good version with --json, then check another version against them with
+--compare, which exits with status 1 if any benchmark got slower by more than --tolerance.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import ast
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from nodebook import pickledict
+from nodebook.nodebookcore import Nodebook, ReferenceFinder
+from nodebook.pickledict import PickleDict
+
+timer = getattr(time, 'perf_counter', time.time)
+
+CELL_COUNTS = [10, 100, 1000, 5000]
+QUICK_CELL_COUNTS = [10, 100]
+
+
+def measure(fn, repeat, number=1, setup=None):
+    """
+    Best time of repeat rounds of calling fn number times, in seconds per call
+
+    setup, if given, runs untimed before each round, and its result is passed to fn
+    """
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = timer()
+        for _ in range(number):
+            fn(arg) if setup is not None else fn()
+        elapsed = (timer() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def sample_values(quick):
+    rng = np.random.RandomState(0)
+    rows = 10000 if quick else 1000000
+    return {
+        'scalar': 12345.678,
+        'dict': {'key_%d' % i: [i, str(i), float(i)] for i in range(1000 if quick else 100000)},
+        'array': rng.normal(size=rows * 4),
+        'frame': pd.DataFrame({
+            'id': np.arange(rows),
+            'value': rng.normal(size=rows),
+            'category': pd.Categorical(rng.choice(['a', 'b', 'c'], size=rows)),
+            'name': ['user_%d' % (i % 1000) for i in range(rows)],
+        }),
+    }
+
+
+def bench_values(results, values, repeat, directory):
+    for name, value in sorted(values.items()):
+        number = 1000 if name == 'scalar' else 1
+        results['hash.%s' % name] = measure(lambda: pickledict.hash(value), repeat, number)
+
+        for mode in ('memory', 'disk'):
+            store = PickleDict(tempfile.mkdtemp(dir=directory) if mode == 'disk' else None)
+            key = store.put(value)
+            results['set.%s.%s' % (mode, name)] = measure(lambda: store.__setitem__(key, value), repeat, number)
+            results['get.%s.%s' % (mode, name)] = measure(lambda: store[key], repeat, number)
+            if mode == 'disk':
+                shutil.rmtree(store.persist_path)
+
+
+def large_cell(lines):
+    """
+    Code mixing assignments, loops, comprehensions, calls and function definitions
+    """
+    code = []
+    for i in range(0, lines, 5):
+        code.extend([
+            "v%d = [x * %d for x in data if x > v%d]" % (i, i, max(i - 5, 0)),
+            "for j in range(len(v%d)):" % i,
+            "    total += v%d[j]" % i,
+            "def f%d(a, b=v%d):\n    return a + len(b)" % (i, i),
+            "frame.loc[%d, 'col'] = f%d(total)" % (i, i),
+        ])
+    return "\n".join(code)
+
+
+def bench_code(results, repeat, quick):
+    for lines in ([100, 1000] if quick else [100, 1000, 10000]):
+        code = large_cell(lines)
+        tree = ast.parse(code)
+        results['reference_finder.%d_lines' % lines] = measure(lambda: ReferenceFinder().visit(tree), repeat)
+        # a node compiles each version of its code once, so every round updates a new one
+        nb = Nodebook(PickleDict())
+        node_ids = iter('cell_%d' % i for i in range(repeat))
+
+        def new_node():
+            node_id = next(node_ids)
+            nb.insert_node_after(node_id, None)
+            return node_id
+        results['compile.%d_lines' % lines] = measure(lambda node_id: nb.update_code(node_id, code), repeat,
+                                                      setup=new_node)
+
+
+def chain_notebook(cells):
+    """
+    Nodebook where each cell reads the output of the one before it, and every tenth cell also reads the first
+    """
+    nb = Nodebook(PickleDict())
+    parent = None
+    for i in range(cells):
+        node_id = 'cell_%d' % i
+        nb.insert_node_after(node_id, parent)
+        if i == 0:
+            code = "v0 = 0"
+        elif i % 10 == 0:
+            code = "v%d = v%d + v0 + 1" % (i, i - 1)
+        else:
+            code = "v%d = v%d + 1" % (i, i - 1)
+        nb.update_code(node_id, code)
+        nb.run_node(node_id)
+        parent = node_id
+    return nb
+
+
+def bench_nodebook(results, repeat, cell_counts):
+    for cells in cell_counts:
+        start = timer()
+        nb = chain_notebook(cells)
+        results['nodebook.%d_cells.build_per_cell' % cells] = (timer() - start) / cells
+
+        last = nb.nodes['cell_%d' % (cells - 1)]
+        results['nodebook.%d_cells.run_last' % cells] = measure(lambda: nb.run_node(last.name), repeat, 10)
+        # looks up the first cell's output from the end of the notebook
+        nb.insert_node_after('reader', last.name)
+        nb.update_code('reader', "v0")
+        results['nodebook.%d_cells.run_reading_first' % cells] = measure(lambda: nb.run_node('reader'), repeat, 10)
+
+        def invalidate(value):
+            # changing the first output invalidates every later cell
+            nb.update_code('cell_0', "v0 = %d" % value)
+            nb.run_node('cell_0')
+
+        def revalidate(values=iter(range(1, repeat + 1))):
+            node = nb.head
+            while node is not None:
+                if not node.valid:
+                    nb.run_node(node.name)
+                node = node.child
+            return next(values)
+        results['nodebook.%d_cells.invalidate_all' % cells] = measure(invalidate, repeat, setup=revalidate)
+
+        def insert_middle(i):
+            node_id = 'extra_%d' % i
+            nb.insert_node_after(node_id, 'cell_%d' % (cells // 2))
+            nb.update_code(node_id, "extra = 1")
+        counter = iter(range(repeat))
+        results['nodebook.%d_cells.insert_middle' % cells] = measure(insert_middle, repeat,
+                                                                     setup=lambda: next(counter))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'hash': pickledict.DEFAULT_HASH,
+        'codec': pickledict.DEFAULT_CODEC,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the ratio of each result to the baseline, returning the names of those slower than tolerance allows
+    """
+    regressions = []
+    print('%-48s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  slower'
+        print('%-48s %12.6f %12.6f %8.2f%s' % (name, baseline[name], results[name], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', default=None, help='file to write results to')
+    parser.add_argument('--compare', default=None, help='results file of a baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, as a fraction')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='small values and notebooks, for a smoke test')
+    parser.add_argument('--dir', default=None, help='directory for disk mode, defaults to a temporary directory')
+    parser.add_argument('--only', default=None, help='only run benchmarks in this group: values, code or nodebook')
+    args = parser.parse_args()
+
+    results = {}
+    if args.only in (None, 'values'):
+        bench_values(results, sample_values(args.quick), args.repeat, args.dir)
+    if args.only in (None, 'code'):
+        bench_code(results, args.repeat, args.quick)
+    if args.only in (None, 'nodebook'):
+        bench_nodebook(results, args.repeat, QUICK_CELL_COUNTS if args.quick else CELL_COUNTS)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+    else:
+        regressions = []
+        for name in sorted(results):
+            print('%-48s %12.6f' % (name, results[name]))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'repeat': args.repeat, 'quick': args.quick,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('%d benchmarks slower than baseline by more than %d%%' % (len(regressions), args.tolerance * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,17 @@ define([
             }
         }
 
+        function handle_stats_payload(payload) {
+            var cells = this.notebook.get_cells();
+            var cell_by_id = cells.find(function(cell, index){return cell.cell_id == payload['cell_id']});
+
+            try {
+                cell_by_id.element.find('div.input_prompt').attr('title', payload['summary'])
+            } catch(err) {
+                console.log(err)
+            }
+        }
+
         function patch_CodeCell_execute () {
             console.info('[Nodebook] Patching cell execute')
             CodeCell.prototype.execute = function (stop_on_error) {
@@ -73,6 +84,7 @@ define([
 
                 // add in an extra callback here -- probably not the best place though
                 callbacks['shell']['payload']['set_prompt'] = $.proxy(handle_test_payload, this);
+                callbacks['shell']['payload']['node_stats'] = $.proxy(handle_stats_payload, this);
 
 
                 // first get any pragmas
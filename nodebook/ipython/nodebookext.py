@@ -1,27 +1,98 @@
 from __future__ import absolute_import
+from __future__ import print_function
 import six.moves.cPickle as pickle
 import os
 import sys
 import errno
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 
 from nodebook.nodebookcore import Node, Nodebook, ReferenceFinder
-from nodebook.pickledict import PickleDict
+from nodebook.pickledict import PickleDict, SharedPickleDict
+from nodebook.objectcache import DEFAULT_MAX_BYTES
+from nodebook.journal import Journal
 
 NODEBOOK_STATE = {
     "cache_dir": None,
     "nodebook": None,
+    "journal": None,
+    "state_writer": None,
+    "state_writes": [],
 }
 
+# nodebook state file written by versions before the journal
+LEGACY_STATE_FILE = 'nodebook.p'
+
 MODE_DISK = "disk"
 MODE_MEMORY = "memory"
 ALLOWED_MODES = [MODE_DISK, MODE_MEMORY]
 
 
+def _parse_options(args):
+    """
+    Split magic arguments into positional arguments and key=value options
+    """
+    positional = []
+    options = {}
+    for arg in args:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            options[key] = value
+        elif arg:
+            positional.append(arg)
+    return positional, options
+
+
+def _parse_bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise SyntaxError("Expected a boolean option value, got %r" % value)
+
+
 def nodebook(line):
     """
     ipython magic for initializing nodebook, expects name for nodebook database
+
+    Accepts key=value options after the mode and name:
+        cache_mb: memory budget for live input objects reused between cells (default 256, 0 disables)
+        readonly: if true, pass arrays and DataFrames to cells as read-only views instead of copies
+        codec: compression codec for values stored on disk, one of pickledict.CODECS
+        level: compression level for the codec
+        write_behind: if true, write outputs and nodebook state to disk on background threads
+        memoize: if true, skip running cells whose code and inputs match an earlier run, restoring its outputs
+        strict: if true, hash every input after each run to detect changes, including inputs a cell only reads
+        quota_mb: size limit for stored values, evicting old outputs to be recomputed when needed (default none)
+        stats: if true, show the profile of each cell's latest run in a tooltip on its prompt
+        threads: number of threads hashing, storing and loading a cell's inputs and outputs in parallel
+        shared: in disk mode, directory to store values in for new nodebooks, shared with other nodebooks using it
+        memory_mb: in memory mode, RAM budget for stored values, spilling the least recently used to disk beyond it
+        spill_dir: in memory mode, directory for the temporary directory values spill to (default the system's)
+        chunked: if true, in disk mode, store values as chunks shared with similar values, e.g. earlier versions
+        lazy: if true, load each input when a cell first reads it, skipping inputs it never touches
     """
-    args = line.lstrip().split(' ')
+    args, options = _parse_options(line.lstrip().split(' '))
+    try:
+        cache_bytes = int(float(options.pop('cache_mb', DEFAULT_MAX_BYTES / 1024 ** 2)) * 1024 ** 2)
+        level = int(options.pop('level')) if 'level' in options else None
+        quota_bytes = int(float(options.pop('quota_mb')) * 1024 ** 2) if 'quota_mb' in options else None
+        threads = int(options.pop('threads')) if 'threads' in options else None
+        memory_bytes = int(float(options.pop('memory_mb')) * 1024 ** 2) if 'memory_mb' in options else None
+    except ValueError:
+        raise SyntaxError("cache_mb, level, quota_mb, threads and memory_mb must be numbers")
+    readonly = _parse_bool(options.pop('readonly', 'false'))
+    codec = options.pop('codec', None)
+    write_behind = _parse_bool(options.pop('write_behind', 'false'))
+    memoize = _parse_bool(options.pop('memoize', 'false'))
+    strict = _parse_bool(options.pop('strict', 'false'))
+    emit_stats = _parse_bool(options.pop('stats', 'false'))
+    lazy_inputs = _parse_bool(options.pop('lazy', 'false'))
+    shared = options.pop('shared', None)
+    spill_path = options.pop('spill_dir', None)
+    chunked = _parse_bool(options.pop('chunked', 'false'))
+    if options:
+        raise SyntaxError("Unknown options %s" % sorted(options))
 
     try:
         mode = args[0]
@@ -33,6 +104,14 @@ def nodebook(line):
         persist = False
     else:
         persist = True
+    if shared is not None:
+        if not persist:
+            raise SyntaxError("shared requires %s mode" % MODE_DISK)
+        shared = os.path.abspath(shared)
+    if persist and (memory_bytes is not None or spill_path is not None):
+        raise SyntaxError("memory_mb and spill_dir require %s mode" % MODE_MEMORY)
+    if chunked and (not persist or shared is not None):
+        raise SyntaxError("chunked requires %s mode without shared" % MODE_DISK)
 
     if persist:
         NODEBOOK_STATE['cache_dir'] = 'nodebook_cache/'
@@ -48,15 +127,57 @@ def nodebook(line):
                 pass
             else:
                 raise
-        try:
-            with open(os.path.join(NODEBOOK_STATE['cache_dir'], 'nodebook.p'), 'rb') as f:
-                NODEBOOK_STATE['nodebook'] = pickle.load(f)
-        except IOError:
+        journal = Journal(NODEBOOK_STATE['cache_dir'])
+        legacy_path = os.path.join(NODEBOOK_STATE['cache_dir'], LEGACY_STATE_FILE)
+        if journal.exists():
+            nb = journal.load()
+        elif os.path.exists(legacy_path):
+            with open(legacy_path, 'rb') as f:
+                nb = pickle.load(f)
+        elif shared is not None:
+            nb = Nodebook(SharedPickleDict(shared))
+        else:
             var_store = PickleDict(NODEBOOK_STATE['cache_dir'])
-            NODEBOOK_STATE['nodebook'] = Nodebook(var_store)
+            nb = Nodebook(var_store)
+        var_store = nb.variables
+        if chunked and isinstance(var_store, SharedPickleDict):
+            raise SyntaxError("Nodebook %s stores its values in shared %s, which can't be chunked" % (
+                NODEBOOK_STATE['cache_dir'], var_store.persist_path))
+        if shared is not None and (not isinstance(var_store, SharedPickleDict) or var_store.persist_path != shared):
+            raise SyntaxError("Nodebook %s already stores its values in %s" % (
+                NODEBOOK_STATE['cache_dir'], var_store.persist_path))
+        NODEBOOK_STATE['nodebook'] = nb
+        NODEBOOK_STATE['journal'] = journal
     else:
-        var_store = PickleDict()
+        var_store = PickleDict(memory_bytes=memory_bytes, spill_path=spill_path)
         NODEBOOK_STATE['nodebook'] = Nodebook(var_store)
+        NODEBOOK_STATE['journal'] = None
+    NODEBOOK_STATE['nodebook'].cache.resize(cache_bytes)
+    NODEBOOK_STATE['nodebook'].readonly_inputs = readonly
+    NODEBOOK_STATE['nodebook'].memoize = memoize
+    NODEBOOK_STATE['nodebook'].strict = strict
+    NODEBOOK_STATE['nodebook'].quota_bytes = quota_bytes
+    NODEBOOK_STATE['nodebook'].emit_stats = emit_stats
+    NODEBOOK_STATE['nodebook'].lazy_inputs = lazy_inputs
+    var_store = NODEBOOK_STATE['nodebook'].variables
+    if codec is not None or level is not None:
+        var_store.set_codec(codec if codec is not None else var_store.codec, level)
+    var_store.write_behind = write_behind and persist
+    var_store.chunked = chunked
+    if threads is not None:
+        var_store.batch_workers = threads
+    if var_store.write_behind and NODEBOOK_STATE['state_writer'] is None:
+        # a single thread keeps state snapshots in order
+        NODEBOOK_STATE['state_writer'] = ThreadPoolExecutor(max_workers=1)
+
+    if persist:
+        # record the settings, starting a fresh journal for new and legacy nodebooks
+        if journal.exists():
+            journal.append(journal.meta(NODEBOOK_STATE['nodebook']))
+        else:
+            journal.replace(journal.snapshot(NODEBOOK_STATE['nodebook']))
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
 
     if len(NODEBOOK_STATE['nodebook'].nodes) > 0:
         NODEBOOK_STATE['nodebook'].update_all_prompts(get_ipython().payload_manager)
@@ -79,14 +200,12 @@ def execute_cell(line, cell):
     # update code and run
     NODEBOOK_STATE['nodebook'].update_code(cell_id, cell)
     res, objs = NODEBOOK_STATE['nodebook'].run_node(cell_id)
+    NODEBOOK_STATE['nodebook'].enforce_quota()
 
     # update prompts
     NODEBOOK_STATE['nodebook'].update_all_prompts(get_ipython().payload_manager)
 
-    # update cache if needed
-    if NODEBOOK_STATE['cache_dir'] is not None:
-        with open(os.path.join(NODEBOOK_STATE['cache_dir'], 'nodebook.p'), 'wb') as f:
-            pickle.dump(NODEBOOK_STATE['nodebook'], f, protocol=2)
+    _journal_changes()
 
     # UGLY HACK - inject outputs into global environment for autocomplete support
     # TODO: find a better way to handle autocomplete
@@ -94,11 +213,85 @@ def execute_cell(line, cell):
     return res
 
 
+def nodebook_gc(line):
+    """
+    ipython magic for deleting stored values no longer referenced by the nodebook, then enforcing its size quota
+
+    Accepts an optional quota_mb=N option overriding the quota set with %nodebook
+    """
+    assert NODEBOOK_STATE['nodebook'] is not None, "Nodebook not initialized, please use %nodebook {nodebook_name}"
+    args, options = _parse_options(line.strip().split(' '))
+    try:
+        quota_bytes = int(float(options.pop('quota_mb')) * 1024 ** 2) if 'quota_mb' in options else None
+    except ValueError:
+        raise SyntaxError("quota_mb must be a number")
+    if args or options:
+        raise SyntaxError("Unknown arguments %s" % (args + sorted(options)))
+
+    flush()
+    swept = NODEBOOK_STATE['nodebook'].gc()
+    evicted = NODEBOOK_STATE['nodebook'].enforce_quota(quota_bytes)
+    NODEBOOK_STATE['nodebook'].update_all_prompts(get_ipython().payload_manager)
+    _journal_changes()
+
+    print("removed %d unreferenced values (%.1f MB)" % (swept['values'], swept['bytes'] / 1024.0 ** 2))
+    if evicted['values']:
+        print("evicted %d values (%.1f MB), %d cells will be re-run when needed" % (
+            evicted['values'], evicted['bytes'] / 1024.0 ** 2, len(evicted['nodes'])))
+
+
+def nodebook_stats(line):
+    """
+    ipython magic returning a DataFrame profiling the latest run of each cell, see Nodebook.stats_frame
+
+    Accepts an optional column name to sort by, largest first, e.g. %nodebook_stats total
+    """
+    assert NODEBOOK_STATE['nodebook'] is not None, "Nodebook not initialized, please use %nodebook {nodebook_name}"
+    args, options = _parse_options(line.strip().split(' '))
+    frame = NODEBOOK_STATE['nodebook'].stats_frame()
+    if len(args) > 1 or options:
+        raise SyntaxError("Unknown arguments %s" % (args[1:] + sorted(options)))
+    if args:
+        if args[0] not in frame.columns:
+            raise SyntaxError("Can't sort by %s, expected one of %s" % (args[0], list(frame.columns)))
+        frame = frame.sort_values(args[0], ascending=False)
+    return frame
+
+
+def _journal_changes():
+    """
+    Journal changes to the nodebook, if persisted
+    """
+    if NODEBOOK_STATE['journal'] is not None:
+        write = NODEBOOK_STATE['journal'].commit(NODEBOOK_STATE['nodebook'])
+        if NODEBOOK_STATE['nodebook'].variables.write_behind:
+            # changes are serialized now, but written in the background
+            writes = [w for w in NODEBOOK_STATE['state_writes'] if not w.done() or w.exception() is not None]
+            writes.append(NODEBOOK_STATE['state_writer'].submit(write))
+            NODEBOOK_STATE['state_writes'] = writes
+        else:
+            write()
+
+
+def flush():
+    """
+    Wait for any background writes of outputs and nodebook state to finish
+    """
+    writes, NODEBOOK_STATE['state_writes'] = NODEBOOK_STATE['state_writes'], []
+    for write in writes:
+        write.result()
+    if NODEBOOK_STATE['nodebook'] is not None:
+        NODEBOOK_STATE['nodebook'].variables.flush()
+
+
 def load_ipython_extension(ipython):
     ipython.register_magic_function(nodebook, magic_kind='line')
     ipython.register_magic_function(execute_cell, magic_kind='cell')
+    ipython.register_magic_function(nodebook_gc, magic_kind='line')
+    ipython.register_magic_function(nodebook_stats, magic_kind='line')
+    atexit.register(flush)
     ipython.run_cell_magic('javascript', '', "Jupyter.utils.load_extensions('nodebook/nodebookext')")
 
 
 def unload_ipython_extension(ipython):
-    pass
+    flush()
@@ -0,0 +1,300 @@
+from __future__ import absolute_import
+import copy
+import marshal
+import os
+from collections import OrderedDict
+from functools import partial
+import struct
+import zlib
+import msgpack
+import six
+import six.moves.cPickle as pickle
+
+from .nodebookcore import Node, _memo_hashes
+
+JOURNAL_FILE = 'nodebook.journal'
+
+# record header: kind, node id length, payload length, crc32 of node id + payload
+RECORD_HEADER = struct.Struct('>cHII')
+
+# nodebook settings and variable store configuration, as a pickled Nodebook without nodes
+META = b'M'
+# node position, validity and input/output hashes
+STATE = b'N'
+# node code, imports and compiled code
+CODE = b'C'
+# memoized run, keyed by memo key instead of node id, with an empty payload once forgotten
+MEMO = b'R'
+
+# compact once the journal holds this many times more records than live ones
+COMPACT_FACTOR = 4
+# ...but never for fewer records than this
+COMPACT_MIN_RECORDS = 256
+
+
+def _pack_record(kind, node_id, payload):
+    node_id = node_id.encode('utf-8')
+    crc = zlib.crc32(node_id + payload) & 0xffffffff
+    return RECORD_HEADER.pack(kind, len(node_id), len(payload), crc) + node_id + payload
+
+
+def _read_records(f):
+    """
+    Yield (kind, node id, payload, end offset) for each intact record, stopping at the first torn or
+    corrupt one, as left by a crash mid-append
+    """
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        kind, id_length, payload_length, crc = RECORD_HEADER.unpack(header)
+        body = f.read(id_length + payload_length)
+        if len(body) < id_length + payload_length or zlib.crc32(body) & 0xffffffff != crc:
+            return
+        yield kind, body[:id_length].decode('utf-8'), body[id_length:], f.tell()
+
+
+def _node_state(node):
+    return {
+        'parent': node.parent.name if node.parent is not None else None,
+        'valid': node.valid,
+        'inputs': dict(node.inputs),
+        'outputs': dict(node.outputs),
+        'last_run': getattr(node, 'last_run', None),
+    }
+
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:  # python 2
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+
+def _node_code(node):
+    try:
+        compiled = dict(node.compiled_code())
+    except SyntaxError:
+        compiled = None
+    else:
+        # code objects are only readable by the python version that wrote them
+        compiled['magic'] = MAGIC_NUMBER
+        compiled['block'] = marshal.dumps(compiled['block'])
+        if compiled['expr'] is not None:
+            compiled['expr'] = marshal.dumps(compiled['expr'])
+    return {
+        'code': node.code,
+        'imports': sorted(node.imports),
+        'compiled': compiled,
+    }
+
+
+def _code_attributes(payload):
+    """
+    Node attributes restored from a code record, see Node.deferred
+    """
+    code = msgpack.unpackb(payload, raw=False)
+    attributes = {'code': code['code'], 'imports': set(code['imports'])}
+    compiled = code.get('compiled')
+    if compiled is not None and compiled.pop('magic') == MAGIC_NUMBER:
+        compiled['block'] = marshal.loads(compiled['block'])
+        if compiled['expr'] is not None:
+            compiled['expr'] = marshal.loads(compiled['expr'])
+        attributes['compiled'] = compiled
+    return attributes
+
+
+class Journal(object):
+    """
+    Append-only log of nodebook state, replacing a full pickle of the Nodebook after every cell
+
+    Each commit appends records only for nodes whose state or code changed since the last commit. Records are
+    checksummed, so a record torn by a crash is discarded on load along with anything after it. The journal is
+    periodically compacted by rewriting it with only the latest record of each kind per node.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, JOURNAL_FILE)
+        self.written_states = {}
+        self.written_codes = {}
+        self.written_memos = set()
+        self.records = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self, lazy=True):
+        """
+        Rebuild the Nodebook by replaying the journal
+
+        With lazy, only node order, validity and input/output hashes are restored up front; each node's code and
+        imports are read from the journal the first time they are used.
+        """
+        meta = None
+        states = {}
+        codes = {}
+        memos = OrderedDict()
+        end = 0
+        with open(self.path, 'rb') as f:
+            for kind, node_id, payload, end in _read_records(f):
+                self.records += 1
+                if kind == META:
+                    meta = payload
+                elif kind == STATE:
+                    states[node_id] = payload
+                elif kind == CODE:
+                    codes[node_id] = (end - len(payload), len(payload)) if lazy else payload
+                elif kind == MEMO:
+                    memos.pop(node_id, None)
+                    if payload:
+                        memos[node_id] = payload
+        if meta is None:
+            raise IOError("No nodebook settings found in %s" % self.path)
+        if end < os.path.getsize(self.path):
+            # drop a torn record so appends start from a clean boundary
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+        nodebook = pickle.loads(meta)
+        for node_id, payload in six.iteritems(states):
+            state = msgpack.unpackb(payload, raw=False)
+            if lazy and node_id in codes:
+                node = Node.deferred(node_id, partial(self._load_code, node_id, *codes[node_id]))
+            else:
+                node = Node(node_id)
+            node.valid = state['valid']
+            node.inputs = state['inputs']
+            node.outputs = state['outputs']
+            node.last_run = state.get('last_run')
+            nodebook.nodes[node_id] = node
+            self.written_states[node_id] = state
+        if not lazy:
+            for node_id, payload in six.iteritems(codes):
+                if node_id in nodebook.nodes:
+                    attributes = _code_attributes(payload)
+                    nodebook.nodes[node_id].__dict__.update(attributes)
+                    self.written_codes[node_id] = attributes['code']
+
+        # relink the list from parent ids
+        for node_id, state in six.iteritems(self.written_states):
+            node = nodebook.nodes[node_id]
+            parent = nodebook.nodes.get(state['parent'])
+            if parent is None:
+                nodebook.head = node
+            else:
+                node.parent = parent
+                parent.child = node
+
+        # references are exactly the node outputs and memoized runs
+        for node in six.itervalues(nodebook.nodes):
+            for val_hash in six.itervalues(node.outputs):
+                nodebook.add_ref(val_hash)
+        for memo_key, payload in six.iteritems(memos):
+            entry = msgpack.unpackb(payload, raw=False)
+            nodebook.memo[memo_key] = entry
+            for val_hash in _memo_hashes(entry):
+                nodebook.add_ref(val_hash)
+        self.written_memos = set(memos)
+        nodebook.reindex()
+        nodebook.variables.reindex()
+        return nodebook
+
+    def _load_code(self, node_id, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            attributes = _code_attributes(f.read(length))
+        self.written_codes[node_id] = attributes['code']
+        return attributes
+
+    def diff(self, nodebook):
+        """
+        Serialize records for everything that changed since the last diff, marking it as written
+        """
+        records = []
+        for node_id, node in six.iteritems(nodebook.nodes):
+            state = _node_state(node)
+            if self.written_states.get(node_id) != state:
+                records.append(_pack_record(STATE, node_id, msgpack.packb(state, use_bin_type=True)))
+                self.written_states[node_id] = state
+            if not node.code_loaded:
+                # code that was never read can't have changed
+                continue
+            written_code = self.written_codes.get(node_id)
+            if written_code is None or written_code != node.code:
+                code = _node_code(node)
+                records.append(_pack_record(CODE, node_id, msgpack.packb(code, use_bin_type=True)))
+                self.written_codes[node_id] = node.code
+        for memo_key in set(nodebook.memo) - self.written_memos:
+            records.append(_pack_record(MEMO, memo_key, msgpack.packb(nodebook.memo[memo_key], use_bin_type=True)))
+        for memo_key in self.written_memos - set(nodebook.memo):
+            records.append(_pack_record(MEMO, memo_key, b''))
+        self.written_memos = set(nodebook.memo)
+        self.records += len(records)
+        return b''.join(records)
+
+    def snapshot(self, nodebook):
+        """
+        Serialize a compacted journal holding only the current state of nodebook
+        """
+        for node in six.itervalues(nodebook.nodes):
+            # the old journal holding unread code is about to be replaced
+            node.code
+        self.written_states = {}
+        self.written_codes = {}
+        self.written_memos = set()
+        self.records = 1
+        return _pack_record(META, '', self._settings(nodebook)) + self.diff(nodebook)
+
+    def meta(self, nodebook):
+        """
+        Serialize a record of the nodebook settings, e.g. after they were changed
+        """
+        self.records += 1
+        return _pack_record(META, '', self._settings(nodebook))
+
+    def _settings(self, nodebook):
+        shell = copy.copy(nodebook)
+        shell.nodes = {}
+        shell.head = None
+        shell.refcount = {}
+        shell.memo = OrderedDict()
+        shell.stats = {}
+        shell.unsent_stats = set()
+        shell.reindex()
+        return pickle.dumps(shell, protocol=2)
+
+    def needs_compaction(self, nodebook):
+        live = 1 + 2 * len(nodebook.nodes) + len(nodebook.memo)
+        return self.records > max(COMPACT_MIN_RECORDS, COMPACT_FACTOR * live)
+
+    def append(self, records):
+        """
+        Durably append serialized records
+        """
+        if not records:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replace(self, snapshot):
+        """
+        Atomically replace the journal with a serialized snapshot
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def commit(self, nodebook):
+        """
+        Serialize changes to nodebook and return a function that writes them, which can run in the background
+        """
+        if self.needs_compaction(nodebook):
+            snapshot = self.snapshot(nodebook)
+            return lambda: self.replace(snapshot)
+        records = self.diff(nodebook)
+        return lambda: self.append(records)
@@ -1,25 +1,197 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from . import pickledict
+from .objectcache import ObjectCache, DEFAULT_MAX_BYTES, readonly_view
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 import ast
+import hashlib
+import time
+import pandas as pd
 import six.moves.builtins
 import six
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # python 2 without the futures backport
+    ProcessPoolExecutor = None
+
 INDENT = '    '  # an indent is canonically 4 spaces ;)
 
+# wall clock for profiling node runs
+timer = getattr(time, 'perf_counter', time.time)
+
+# phases of a node run timed by Nodebook.run_node, in order, see Nodebook.stats_frame
+PHASES = ['resolve', 'memo', 'load', 'run', 'store', 'commit']
+# counts kept for each node run: serialized bytes moved, input cache use, values hashed and inputs loaded or not
+STAT_COUNTERS = ['bytes_read', 'bytes_written', 'cache_hits', 'cache_misses', 'hashed', 'loaded', 'untouched']
+
+# spacing between node position labels, leaving room to insert nodes without relabeling
+POSITION_STEP = 1 << 20
+
+# number of earlier runs remembered when memoizing
+DEFAULT_MEMO_SIZE = 1024
+
+# methods that don't modify the object they're called on, any other method call is assumed to
+PURE_METHODS = {
+    'abs', 'agg', 'aggregate', 'all', 'any', 'apply', 'argmax', 'argmin', 'argsort', 'astype', 'copy', 'corr',
+    'count', 'cov', 'cummax', 'cummin', 'cumprod', 'cumsum', 'describe', 'diff', 'dot', 'drop', 'drop_duplicates',
+    'dropna', 'endswith', 'fillna', 'filter', 'format', 'get', 'groupby', 'head', 'idxmax', 'idxmin', 'isin',
+    'isna', 'isnull', 'items', 'join', 'keys', 'lower', 'map', 'max', 'mean', 'median', 'melt', 'merge', 'min',
+    'nlargest', 'notna', 'notnull', 'nsmallest', 'nunique', 'pivot', 'pivot_table', 'predict', 'predict_proba',
+    'quantile', 'query', 'rank', 'ravel', 'rename', 'replace', 'reset_index', 'reshape', 'resample', 'rolling',
+    'round', 'score', 'set_index', 'shift', 'sort_index', 'sort_values', 'split', 'stack', 'startswith', 'std',
+    'strip', 'sum', 'tail', 'to_dict', 'to_list', 'to_numpy', 'tolist', 'transform', 'transpose', 'unique',
+    'unstack', 'upper', 'value_counts', 'values', 'var',
+}
+
+# module functions, e.g. np.log or pd.concat, that don't modify their arguments
+PURE_FUNCTIONS = {
+    'absolute', 'allclose', 'arccos', 'arcsin', 'arctan', 'arctan2', 'around', 'array', 'array_equal',
+    'asarray', 'bincount', 'ceil', 'clip', 'column_stack', 'concat', 'concatenate', 'corrcoef', 'cos', 'cosh',
+    'crosstab', 'cumprod', 'cut', 'digitize', 'divide', 'exp', 'expm1', 'floor', 'full_like', 'get_dummies',
+    'histogram', 'hstack', 'isclose', 'isfinite', 'isinf', 'isnan', 'linspace', 'log', 'log10', 'log1p', 'log2',
+    'matmul', 'maximum', 'merge_asof', 'minimum', 'multiply', 'nanmax', 'nanmean', 'nanmedian', 'nanmin',
+    'nanpercentile', 'nanstd', 'nansum', 'nonzero', 'ones_like', 'outer', 'percentile', 'power', 'prod', 'qcut',
+    'searchsorted', 'sign', 'sin', 'sinh', 'sort', 'sqrt', 'square', 'subtract', 'tan', 'tanh', 'tile',
+    'to_datetime', 'to_numeric', 'to_timedelta', 'vstack', 'where', 'zeros_like',
+}
+
+# functions that modify their first argument
+MUTATING_FUNCTIONS = {
+    'copyto', 'delattr', 'fill_diagonal', 'heapify', 'heappop', 'heappush', 'heappushpop', 'heapreplace',
+    'insort', 'insort_left', 'insort_right', 'place', 'put', 'put_along_axis', 'putmask', 'setattr', 'shuffle',
+}
+
+# syntax defining functions, whose bodies run after the code defining them
+FUNCTION_NODES = tuple(getattr(ast, name) for name in ['FunctionDef', 'AsyncFunctionDef', 'Lambda'] if hasattr(ast, name))
+
+
+def _root_name(node):
+    """
+    Name of the variable at the root of an attribute, subscript or call chain like x.a[0].b(), if any
+    """
+    while type(node) in {ast.Attribute, ast.Subscript, ast.Call}:
+        node = node.func if type(node) is ast.Call else node.value
+    return node.id if type(node) is ast.Name else None
+
+
+def _loaded_names(node):
+    return {n.id for n in ast.walk(node) if type(n) is ast.Name and type(n.ctx) is ast.Load}
+
+
+def _stored_names(node):
+    return {n.id for n in ast.walk(node) if type(n) is ast.Name and type(n.ctx) is ast.Store}
+
+
+def _deferred_names(tree):
+    """
+    Names read inside functions and lambdas defined by the code, which may only be read after it has run
+    """
+    deferred = set()
+    for node in ast.walk(tree):
+        if isinstance(node, FUNCTION_NODES):
+            deferred.update(_loaded_names(node))
+    return deferred
+
 
 class ReferenceFinder(ast.NodeVisitor):
     def __init__(self):
         self.locals = set()
         self.inputs = set()
         self.imports = set()
+        # names whose object the code may modify in place, and names bound to expressions of other names
+        self.mutated = set()
+        self.aliases = {}
+
+    def possibly_mutated(self):
+        """
+        Names whose objects the code may modify in place, directly or through another name bound to them
+        """
+        mutated = set(self.mutated)
+        pending = list(mutated)
+        while pending:
+            for source in self.aliases.get(pending.pop(), ()):
+                if source not in mutated:
+                    mutated.add(source)
+                    pending.append(source)
+        return mutated
+
+    def _alias(self, target, value):
+        sources = _loaded_names(value)
+        for name in _stored_names(target):
+            self.aliases.setdefault(name, set()).update(sources)
+
+    def _mutate(self, node):
+        if type(node) in {ast.Tuple, ast.List}:
+            for elt in node.elts:
+                self._mutate(elt)
+        elif type(node).__name__ == 'Starred':
+            self._mutate(node.value)
+        elif _root_name(node) is not None:
+            self.mutated.add(_root_name(node))
 
     def visit_Assign(self, node):
         # we need to visit "value" before "targets"
         self.visit(node.value)
         for target in node.targets:
+            self._alias(target, node.value)
             self.visit(target)
 
+    def visit_For(self, node):
+        self._alias(node.target, node.iter)
+        self.generic_visit(node)
+
+    def visit_comprehension(self, node):
+        self._alias(node.target, node.iter)
+        self.generic_visit(node)
+
+    def visit_withitem(self, node):
+        if node.optional_vars is not None:
+            self._alias(node.optional_vars, node.context_expr)
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if type(node.ctx) in {ast.Store, ast.Del}:
+            self._mutate(node.value)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if type(node.ctx) in {ast.Store, ast.Del}:
+            self._mutate(node.value)
+        self.generic_visit(node)
+
+    def _mutate_args(self, node):
+        for arg in node.args:
+            self._mutate(arg)
+        for kw in node.keywords:
+            self._mutate(kw.value)
+
+    def visit_Call(self, node):
+        func = node.func
+        if type(func) is ast.Attribute:
+            name = func.attr
+            if name not in PURE_METHODS or any(kw.arg == 'inplace' for kw in node.keywords):
+                self._mutate(func.value)
+                if name not in PURE_FUNCTIONS:
+                    # e.g. operator.setitem(x, 0, 1) or np.add.at(a, idx, 1) modify their arguments
+                    self._mutate_args(node)
+        elif type(func) is ast.Name:
+            name = func.id
+            if name not in six.moves.builtins.__dict__:
+                # a function of our own could modify anything passed to it
+                self._mutate_args(node)
+        else:
+            name = None
+        if name in MUTATING_FUNCTIONS and node.args:
+            self._mutate(node.args[0])
+        for kw in node.keywords:
+            if kw.arg == 'out':
+                self._mutate(kw.value)
+        self.generic_visit(node)
+
     def generic_comp(self, node):
         # we need to visit generators before elt
         for generator in node.generators:
@@ -50,11 +222,11 @@ class ReferenceFinder(ast.NodeVisitor):
         self.locals.add(node.arg)
 
     def visit_AugAssign(self, node):
-        target = node.target
-        while (type(target) is ast.Subscript):
-            target = target.value
-        if target.id not in self.locals:
-            self.inputs.add(target.id)
+        target = _root_name(node.target)
+        if target not in self.locals:
+            self.inputs.add(target)
+        # e.g. += extends lists and adds to arrays in place
+        self.mutated.add(target)
         self.generic_visit(node)
 
     def visit_Name(self, node):
@@ -77,11 +249,180 @@ class Nodebook(object):
     Nodebook maintains a variable store for accessing variables and a pointer to the head node in the list
     """
 
-    def __init__(self, variable_store):
+    def __init__(self, variable_store, cache_bytes=DEFAULT_MAX_BYTES, readonly_inputs=False, memoize=False,
+                 memo_size=DEFAULT_MEMO_SIZE, strict=False, quota_bytes=None, emit_stats=False, lazy_inputs=False):
+        """
+        variable_store: PickleDict holding all variable values by hash
+        cache_bytes: budget for live objects kept in memory to skip repeated loads of the same input
+        readonly_inputs: pass arrays and frames to cells as read-only views of cached objects rather than copies
+        memoize: skip running a node whose code and input hashes match an earlier run, restoring its outputs
+        memo_size: number of earlier runs remembered for memoize
+        strict: hash every input after a run to detect changes, even those the code only reads
+        quota_bytes: if set, enforce_quota evicts values to keep the store within this size
+        emit_stats: send the profile of each run to the frontend along with prompts, see update_all_prompts
+        lazy_inputs: load each input when the code first reads it, skipping inputs a run never touches
+        """
         self.variables = variable_store
+        self.cache = ObjectCache(variable_store, cache_bytes)
+        self.readonly_inputs = readonly_inputs
+        self.memoize = memoize
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.strict = strict
+        self.quota_bytes = quota_bytes
+        self.emit_stats = emit_stats
+        self.lazy_inputs = lazy_inputs
+        self.stats = {}
+        self.unsent_stats = set()
         self.refcount = {}
         self.head = None
         self.nodes = {}
+        self.reindex()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'cache' not in state:
+            # pickled before the object cache existed
+            self.cache = ObjectCache(self.variables)
+        self.__dict__.setdefault('readonly_inputs', False)
+        self.__dict__.setdefault('memoize', False)
+        self.__dict__.setdefault('memo_size', DEFAULT_MEMO_SIZE)
+        self.__dict__.setdefault('memo', OrderedDict())
+        self.__dict__.setdefault('strict', False)
+        self.__dict__.setdefault('quota_bytes', None)
+        self.__dict__.setdefault('emit_stats', False)
+        self.__dict__.setdefault('lazy_inputs', False)
+        self.__dict__.setdefault('stats', {})
+        self.__dict__.setdefault('unsent_stats', set())
+        if 'consumers' not in state:
+            self.reindex()
+
+    def reindex(self):
+        """
+        Rebuild node positions and the index of producing nodes from the node list
+
+        Nodes get increasing integer position labels with gaps between them, so a node can usually be placed
+        without relabeling the rest. For each variable, producers holds the sorted positions of the nodes
+        outputting it, making the latest output before any node a bisect away. Dependency edges between nodes are
+        rebuilt from the input hashes of their last runs.
+        """
+        self.positions = {}
+        self.order = []
+        self.at = {}
+        self.producers = {}
+        self.prompts = {}
+        node = self.head
+        position = 0
+        while node is not None:
+            self.positions[node.name] = position
+            self.order.append(position)
+            self.at[position] = node
+            for var in node.outputs:
+                self.producers.setdefault(var, []).append(position)
+            node = node.child
+            position += POSITION_STEP
+        self._link_all()
+
+    def _link_all(self):
+        """
+        Rebuild dependency edges, linking every node that has run to the producers of its inputs
+        """
+        self.sources = {}
+        self.consumers = {}
+        self.readers = {}
+        for node in six.itervalues(self.nodes):
+            if node.name not in self.positions:
+                continue
+            sources = {}
+            for var, val_hash in six.iteritems(node.inputs):
+                if val_hash is None:
+                    continue  # not run since its code changed
+                producer = self._latest_producer(self.positions[node.name] - 1, var)
+                if producer is not None:
+                    sources[var] = producer.name
+            self._link(node, sources)
+
+    def _link(self, node, sources):
+        """
+        Replace the dependency edges into node with edges from sources, a map of input variable to producing node id
+        """
+        for var, producer_id in six.iteritems(self.sources.pop(node.name, {})):
+            consumed = self.consumers[producer_id]
+            consumed[node.name].discard(var)
+            if not consumed[node.name]:
+                del consumed[node.name]
+            self.readers[var].discard(node.name)
+        for var, producer_id in six.iteritems(sources):
+            self.consumers.setdefault(producer_id, {}).setdefault(node.name, set()).add(var)
+            self.readers.setdefault(var, set()).add(node.name)
+        if sources:
+            self.sources[node.name] = sources
+
+    def dependents(self, node_id):
+        """
+        Return ids of all nodes that directly or transitively consumed outputs of node_id, in notebook order
+        """
+        found = set()
+        pending = [node_id]
+        while pending:
+            for consumer_id in self.consumers.get(pending.pop(), ()):
+                if consumer_id not in found:
+                    found.add(consumer_id)
+                    pending.append(consumer_id)
+        return sorted(found, key=self.positions.__getitem__)
+
+    def dependencies(self, node_id):
+        """
+        Return a map of input variable to the id of the node it was read from in the last run of node_id
+        """
+        return dict(self.sources.get(node_id, {}))
+
+    def _unplace(self, node):
+        """
+        Remove node from the position index
+        """
+        position = self.positions.pop(node.name, None)
+        if position is None:
+            return
+        del self.order[bisect_left(self.order, position)]
+        del self.at[position]
+        for var in node.outputs:
+            self._remove_producer(var, position)
+
+    def _place(self, node):
+        """
+        Add node to the position index between its neighbours in the list, relabeling all nodes if there's no gap
+        """
+        before = self.positions[node.parent.name] if node.parent is not None else None
+        after = self.positions[node.child.name] if node.child is not None else None
+        if before is None and after is None:
+            position = 0
+        elif before is None:
+            position = after - POSITION_STEP
+        elif after is None:
+            position = before + POSITION_STEP
+        elif after - before > 1:
+            position = (before + after) // 2
+        else:
+            self.reindex()
+            return
+        self.positions[node.name] = position
+        insort(self.order, position)
+        self.at[position] = node
+        for var in node.outputs:
+            insort(self.producers.setdefault(var, []), position)
+
+    def _remove_producer(self, var, position):
+        positions = self.producers[var]
+        del positions[bisect_left(positions, position)]
+        if not positions:
+            del self.producers[var]
+
+    def get_index(self, node):
+        """
+        Return index of node in the list
+        """
+        return bisect_left(self.order, self.positions[node.name])
 
     def add_ref(self, val_hash):
         """
@@ -95,7 +436,103 @@ class Nodebook(object):
         """
         self.refcount[val_hash] -= 1
         if self.refcount[val_hash] == 0:
-            del self.variables[val_hash]
+            del self.refcount[val_hash]
+            self._delete_value(val_hash)
+
+    def _delete_value(self, val_hash):
+        """
+        Delete a value from the store if it's there, e.g. it may have been evicted, returning the bytes freed
+        """
+        self.cache.discard(val_hash)
+        if val_hash not in self.variables:
+            return 0
+        size = self.variables.size(val_hash)
+        del self.variables[val_hash]
+        return size
+
+    def _live_refcount(self):
+        """
+        Count references to values from node outputs and memoized runs
+        """
+        refcount = {}
+        hashes = [val_hash for node in six.itervalues(self.nodes) for val_hash in six.itervalues(node.outputs)]
+        for entry in six.itervalues(self.memo):
+            hashes.extend(_memo_hashes(entry))
+        for val_hash in hashes:
+            refcount[val_hash] = refcount.get(val_hash, 0) + 1
+        return refcount
+
+    def gc(self):
+        """
+        Delete stored values that no node output or memoized run refers to, e.g. left behind by a crashed session,
+        along with temporary files of interrupted writes
+
+        Returns a dict with the number of values removed and bytes reclaimed
+        """
+        self.variables.reindex()
+        self.refcount = self._live_refcount()
+        values = 0
+        reclaimed = self.variables.remove_temporary_files()
+        for val_hash in list(self.variables.keys()):
+            if val_hash not in self.refcount:
+                reclaimed += self._delete_value(val_hash)
+                values += 1
+        return {'values': values, 'bytes': reclaimed}
+
+    def enforce_quota(self, quota_bytes=None):
+        """
+        Evict stored values until the store fits in quota_bytes, defaulting to the nodebook's quota
+
+        Values only kept for memoized runs go first, least recently used first, then outputs of invalid nodes,
+        then outputs of valid nodes that ran longest ago. Nodes whose outputs are evicted are invalidated, so
+        they are re-run when next needed. Returns a dict with the number of values removed, bytes reclaimed and
+        ids of the nodes invalidated.
+        """
+        quota_bytes = quota_bytes if quota_bytes is not None else self.quota_bytes
+        report = {'values': 0, 'bytes': 0, 'nodes': []}
+        if quota_bytes is None:
+            return report
+        self.variables.flush()
+        total = sum(self.variables.size(val_hash) for val_hash in self.variables.keys())
+
+        # memoized runs whose values no node outputs
+        owners = {}
+        for node in six.itervalues(self.nodes):
+            for val_hash in six.itervalues(node.outputs):
+                owners.setdefault(val_hash, []).append(node)
+        for memo_key in list(self.memo):
+            if total <= quota_bytes:
+                return report
+            entry = self.memo[memo_key]
+            if any(val_hash in owners for val_hash in _memo_hashes(entry)):
+                continue
+            for val_hash in _memo_hashes(entry):
+                if self.refcount[val_hash] == 1:
+                    report['values'] += 1
+                    freed = self._delete_value(val_hash)
+                    report['bytes'] += freed
+                    total -= freed
+            self._forget(memo_key)
+
+        # then node outputs, invalidating every node outputting an evicted value
+        nodes = sorted(six.itervalues(self.nodes), key=lambda node: (node.valid, getattr(node, 'last_run', None) or 0))
+        for node in nodes:
+            if total <= quota_bytes:
+                break
+            for val_hash in six.itervalues(node.outputs):
+                if val_hash not in self.variables:
+                    continue
+                for memo_key in [k for k, entry in six.iteritems(self.memo) if val_hash in _memo_hashes(entry)]:
+                    self._forget(memo_key)
+                for owner in owners[val_hash]:
+                    if owner.valid:
+                        owner.valid = False
+                        report['nodes'].append(owner.name)
+                freed = self._delete_value(val_hash)
+                report['values'] += 1
+                report['bytes'] += freed
+                total -= freed
+        return report
 
     def update_code(self, node_id, code):
         """
@@ -107,64 +544,363 @@ class Nodebook(object):
     def run_node(self, node_id):
         """
         Run target node and retrieve expression result and modified objects
+
+        Each successful run is profiled in self.stats, see _record_stats
         """
-        # get node inputs
+        # get node input hashes
         node = self.nodes[node_id]
-        input_objs = {}
+        stats = _new_stats()
+        start = timer()
         input_hashes = {}
-        for var in node.inputs.keys():
-            val_hash = self._find_latest_output(node.parent, var)
-            if val_hash is not None:
-                input_objs[var] = self.variables[val_hash]
-                input_hashes[var] = val_hash
-
-        # run node
-        res, output_objs, output_hashes = node.run(input_objs, input_hashes)
-
-        # update node outputs
-        for var, val in six.iteritems(output_objs):
-            self.variables[output_hashes[var]] = val
-        self._update_output_hashes(node, output_hashes)
+        sources = {}
+        with _timed(stats, 'resolve'):
+            for var in node.inputs.keys():
+                producer = self._find_producer(node.parent, var)
+                if producer is not None:
+                    sources[var] = producer.name
+                    input_hashes[var] = producer.outputs[var]
+        # producers re-run while resolving inputs are profiled separately
+        counters = self._counters()
+
+        # restore the outputs of an identical earlier run
+        with _timed(stats, 'memo'):
+            memo_key = self._memo_key(node, input_hashes) if self.memoize else None
+            if memo_key in self.memo and not all(h in self.variables for h in _memo_hashes(self.memo[memo_key])):
+                self._forget(memo_key)  # some of its values were evicted or lost
+        if memo_key in self.memo:
+            stats['memo_hit'] = True
+            with _timed(stats, 'commit'):
+                entry = self._recall(memo_key)
+                self._commit(node, sources, input_hashes, dict(entry['outputs']))
+            with _timed(stats, 'load'):
+                output_objs = {var: self.variables[val_hash] for var, val_hash in six.iteritems(node.outputs)}
+                res = self.variables[entry['result']] if entry['result'] is not None else None
+            self._record_stats(node, stats, timer() - start, counters)
+            return res, output_objs
 
+        # load node inputs, all at once so misses load in parallel, or on first use if lazy
+        input_objs = {}
+        cached_objs = {}
+        loaders = {}
+        with _timed(stats, 'load'):
+            # variables sharing a value still get independent copies
+            first, shared = [], []
+            for var, val_hash in six.iteritems(input_hashes):
+                (shared if val_hash in (input_hashes[v] for v in first) else first).append(var)
+            if self.lazy_inputs:
+                for var in first + shared:
+                    loaders[var] = partial(self._load_input, var, input_hashes[var], var in shared, cached_objs)
+            else:
+                objs = self.cache.get_many([input_hashes[var] for var in first])
+                objs += self.variables.get_many([input_hashes[var] for var in shared])
+                for var, obj in zip(first + shared, objs):
+                    input_objs[var] = self._bind_input(var, obj, var in shared, cached_objs)
+                stats['loaded'] = len(input_objs)
+
+        # run node, storing outputs as they are hashed
+        try:
+            res, output_objs, output_hashes = node.run(input_objs, dict(input_hashes), strict=self.strict, stats=stats,
+                                                       hash_many=self.variables.put_many, lazy_inputs=loaders)
+        except BaseException:
+            for var in cached_objs:
+                self.cache.discard(input_hashes[var])
+            raise
+        mutated = node.compiled_code()['mutated']
+        rehashed = {var for var in cached_objs if self.strict or var in mutated}
+        with _timed(stats, 'store'):
+            self._discard_escaped(cached_objs, input_hashes, input_objs, res, output_objs, rehashed)
+
+        # update node inputs and outputs
+        with _timed(stats, 'commit'):
+            self._commit(node, sources, input_hashes, output_hashes)
+            if memo_key is not None:
+                self._remember(memo_key, output_hashes, _put_result(self.variables, res))
+
+        self._record_stats(node, stats, timer() - start, counters)
         return res, output_objs
 
+    def _load_input(self, var, val_hash, shared, cached_objs):
+        """
+        Load input var of a run by hash, through the object cache unless another input shares its value
+        """
+        obj = self.variables[val_hash] if shared else self.cache.get(val_hash)
+        return self._bind_input(var, obj, shared, cached_objs)
+
+    def _bind_input(self, var, obj, shared, cached_objs):
+        """
+        Object to bind input var to for a run, recording it in cached_objs if it's the cached object itself
+        """
+        view = readonly_view(obj) if self.readonly_inputs else None
+        if view is not None:
+            # views can't modify the cached object, so they are safe to share
+            return view
+        if not shared:
+            cached_objs[var] = obj
+        return obj
+
+    def _counters(self):
+        return (self.variables.bytes_read, self.variables.bytes_written, self.cache.hits, self.cache.misses)
+
+    def _record_stats(self, node, stats, total, counters=None):
+        """
+        Keep stats as the profile of node's latest run, counting the bytes read and written and the cache hits
+        and misses since counters were taken, see _counters
+        """
+        stats['total'] = total
+        if counters is not None:
+            for key, before, after in zip(['bytes_read', 'bytes_written', 'cache_hits', 'cache_misses'],
+                                          counters, self._counters()):
+                stats[key] += after - before
+        stats['finished'] = time.time()
+        self.stats[node.name] = stats
+        self.unsent_stats.add(node.name)
+
+    def stats_frame(self):
+        """
+        Return the profile of the latest run of each node as a DataFrame indexed by node id, in notebook order
+
+        Phase columns hold wall time in seconds: resolving input hashes, checking memoized runs, loading inputs
+        from the store, executing the code, hashing and storing outputs, and recording the run. Nodes re-run to
+        resolve inputs are timed in their own rows, not in resolve.
+        """
+        rows = []
+        for index, position in enumerate(self.order, 1):
+            node = self.at[position]
+            if node.name in self.stats:
+                rows.append(dict(self.stats[node.name], node=node.name, cell="N_%d" % index, valid=node.valid))
+        columns = ['node', 'cell', 'valid', 'total'] + PHASES + list(STAT_COUNTERS) + ['memo_hit', 'finished']
+        return pd.DataFrame(rows, columns=columns).set_index('node')
+
+    def _commit(self, node, sources, input_hashes, output_hashes):
+        """
+        Record a run of node on inputs read from sources, a map of variable to producing node id
+        """
+        node.inputs = input_hashes
+        node.valid = True
+        node.last_run = time.time()
+        self._link(node, sources)
+        self._update_output_hashes(node, output_hashes)
+
+    def _memo_key(self, node, input_hashes):
+        """
+        Key runs by the syntax tree of node's code, ignoring formatting and comments, and its input hashes
+        """
+        inputs = [[var, val_hash] for var, val_hash in sorted(six.iteritems(input_hashes))]
+        return pickledict.hash([node.compiled_code()['tree'], inputs], self.variables.hash_name)
+
+    def _recall(self, memo_key):
+        entry = self.memo.pop(memo_key)
+        self.memo[memo_key] = entry  # most recently used
+        return entry
+
+    def _forget(self, memo_key):
+        for val_hash in _memo_hashes(self.memo.pop(memo_key)):
+            self.remove_ref(val_hash)
+
+    def _remember(self, memo_key, output_hashes, res_hash):
+        """
+        Memoize a run, holding references to its outputs and result until it's evicted
+        """
+        if memo_key in self.memo or res_hash is False:
+            return
+        entry = {'outputs': dict(output_hashes), 'result': res_hash}
+        for val_hash in _memo_hashes(entry):
+            self.add_ref(val_hash)
+        self.memo[memo_key] = entry
+        while len(self.memo) > self.memo_size:
+            _, evicted = self.memo.popitem(last=False)
+            for val_hash in _memo_hashes(evicted):
+                self.remove_ref(val_hash)
+
+    def run_stale(self, target=None, workers=None):
+        """
+        Re-run invalid nodes, or only the ones node target needs, running independent nodes concurrently
+
+        Nodes run in waves. A node joins a wave when no stale node before it assigns any of its inputs, and
+        runs in a worker process, with its inputs passed by hash in a subset of the variable store. Results are
+        committed in notebook order. A result whose inputs were changed by an earlier commit is discarded, and its
+        node runs again in a later wave. With workers=1, stale nodes run one at a time in this process.
+        Returns ids of the nodes run, in the order they were committed.
+        """
+        ran = []
+        pool = None
+        try:
+            while True:
+                stale = self._stale_nodes(target)
+                if not stale:
+                    return ran
+                ready = self._ready_nodes(stale)
+                if workers == 1 or len(ready) == 1:
+                    self.run_node(ready[0].name)
+                    ran.append(ready[0].name)
+                    continue
+
+                if pool is None:
+                    if ProcessPoolExecutor is None:
+                        raise ImportError("running nodes in parallel requires concurrent.futures")
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                runs = []
+                for node in ready:
+                    current = self._current_inputs(node)
+                    if current is None:
+                        continue
+                    sources, input_hashes = current
+                    memo_key = self._memo_key(node, input_hashes) if self.memoize else None
+                    future = None
+                    if memo_key not in self.memo:
+                        store = self.variables.subset(set(six.itervalues(input_hashes)))
+                        future = pool.submit(_run_detached, node.code, store, input_hashes, self.memoize,
+                                             self.strict, self.lazy_inputs)
+                    runs.append((node, sources, input_hashes, memo_key, future))
+                for node, sources, input_hashes, memo_key, future in runs:
+                    if future is not None:
+                        output_hashes, res_hash, entries, stats = future.result()
+                    else:
+                        stats = _new_stats()
+                        stats['memo_hit'] = True
+                    if self._current_inputs(node) != (sources, input_hashes):
+                        continue  # an earlier commit changed its inputs
+                    if future is None and memo_key not in self.memo:
+                        continue  # evicted by an earlier commit, run again in the next wave
+                    with _timed(stats, 'commit'):
+                        if future is None:
+                            self._commit(node, sources, input_hashes, dict(self._recall(memo_key)['outputs']))
+                        else:
+                            self.variables.merge(entries)
+                            self._commit(node, sources, input_hashes, output_hashes)
+                            if memo_key is not None:
+                                self._remember(memo_key, output_hashes, res_hash)
+                    self._record_stats(node, stats, stats['total'] + stats['commit'])
+                    ran.append(node.name)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _stale_nodes(self, target=None):
+        """
+        Invalid nodes in notebook order, limited to those that could affect the inputs of target if given
+        """
+        stale = [self.at[position] for position in self.order if not self.at[position].valid]
+        if target is None:
+            return stale
+        target = self.nodes[target]
+        needed = [] if target.valid else [target]
+        wanted = set(target.inputs)
+        for node in reversed(stale):
+            # any node reading a wanted variable could also mutate it
+            outputs = _assignable(node).union(node.inputs)
+            if self.positions[node.name] < self.positions[target.name] and outputs & wanted:
+                needed.append(node)
+                wanted.update(node.inputs)
+        return needed[::-1]
+
+    def _ready_nodes(self, stale):
+        """
+        Stale nodes that can run now, as no stale node before them assigns any of their inputs
+
+        Inputs mutated in place by an earlier node aren't anticipated, as that's rare, but such a node's run is
+        discarded at commit.
+        """
+        ready = []
+        blocked = set()
+        for node in stale:
+            if not blocked.intersection(node.inputs):
+                ready.append(node)
+            blocked.update(_assignable(node))
+        return ready
+
+    def _current_inputs(self, node):
+        """
+        Map node's inputs to the ids and output hashes of their producers, or None if any producer is invalid or
+        its output is missing from the store
+        """
+        sources = {}
+        input_hashes = {}
+        position = self.positions[node.name]
+        for var in node.inputs:
+            producer = self._latest_producer(position - 1, var)
+            if producer is None:
+                if var not in six.moves.builtins.__dict__:
+                    raise KeyError("name '%s' is not defined" % var)
+            elif not producer.valid:
+                return None
+            elif producer.outputs[var] not in self.variables:
+                # evicted or lost, the producer has to run again
+                producer.valid = False
+                return None
+            else:
+                sources[var] = producer.name
+                input_hashes[var] = producer.outputs[var]
+        return sources, input_hashes
+
+    def _discard_escaped(self, cached_objs, input_hashes, env, res, output_objs, rehashed):
+        """
+        Drop cached inputs that a run may have mutated or handed out beyond the cell
+
+        Inputs still bound to their original object are proven unmodified by an unchanged hash. Those the run
+        didn't re-hash could have been changed in ways the mutation analysis missed, so arrays and frames among
+        them are checked with a structural hash of their buffers, and anything else is dropped. Rebound or deleted
+        inputs can't be checked, and inputs returned or output under another name are exposed to the user's
+        namespace.
+        """
+        for var, obj in six.iteritems(cached_objs):
+            unchanged = var in env and env[var] is obj and var not in output_objs
+            if unchanged and var not in rehashed:
+                unchanged = pickledict.structural_hash(obj, self.variables.hash_name) == input_hashes[var]
+            escaped = obj is res or any(obj is out for out in six.itervalues(output_objs))
+            if escaped or not unchanged:
+                self.cache.discard(input_hashes[var])
+
+    def _latest_producer(self, position, var):
+        """
+        Return the last node at or before position outputting var, if any
+        """
+        positions = self.producers.get(var, ())
+        i = bisect_right(positions, position)
+        return self.at[positions[i - 1]] if i > 0 else None
+
     def _find_latest_output(self, node, var):
         """
         Find the most recent output hash for a variable starting from node
         Fails if undefined unless var is a builtin
         """
-        # base case
-        if node is None:
-            if var in six.moves.builtins.__dict__:
-                return None
-            else:
-                raise KeyError("name '%s' is not defined" % var)
+        producer = self._find_producer(node, var)
+        return producer.outputs[var] if producer is not None else None
 
-        if var in node.outputs:
-            # found it, but make sure we're valid
-            if node.valid:
-                return node.outputs[var]
-            else:
-                # re-run the parent if it wasn't valid
-                # TODO: synchronize output with frontend javascript
-                print("auto-running invalidated node N_%s (%s)" % (node.get_index() + 1, node.name))
-                self.run_node(node.name)
-                return self._find_latest_output(node, var)
-        else:
-            # check next parent
-            return self._find_latest_output(node.parent, var)
+    def _find_producer(self, node, var):
+        """
+        Find the most recent valid node outputting a variable starting from node, re-running it if needed
+        Returns None for builtins and fails for anything else undefined
+        """
+        while True:
+            producer = self._latest_producer(self.positions[node.name], var) if node is not None else None
+            if producer is None:
+                if var in six.moves.builtins.__dict__:
+                    return None
+                else:
+                    raise KeyError("name '%s' is not defined" % var)
+            if producer.valid:
+                if producer.outputs[var] in self.variables:
+                    return producer
+                # evicted or lost, so the value has to be computed again
+                producer.valid = False
+
+            # re-run the producer if it wasn't valid, then look again as its outputs may have changed
+            # stale nodes it depends on run first in notebook order, so their own inputs resolve without recursing
+            # TODO: synchronize output with frontend javascript
+            for stale in self._stale_nodes(producer.name):
+                print("auto-running invalidated node N_%s (%s)" % (self.get_index(stale) + 1, stale.name))
+                self.run_node(stale.name)
 
     def _update_output_hashes(self, node, outputs):
         """
         Update node's output hashes and invalid downstream nodes that depended on their previous values
         """
-        # invalidate any any children relying on specific hash-versions of old outputs that aren't in the new outputs
+        # outputs that were dropped or changed
         invalidated_outputs = set(six.iteritems(node.outputs)) - set(six.iteritems(outputs))
         invalidated_outputs = {k: v for k, v in invalidated_outputs}
 
-        # also invalidate any children that rely on any version of a brand-new output, regardless of hash
-        # TODO this is potentially overly restrictive, if, eg, a value is blindly over-written again later
-        # TODO(con't) we should try to account for this to avoid invalidating excessively many cells
+        # outputs that are brand-new or changed
         new_outputs = set(six.iteritems(outputs)) - set(six.iteritems(node.outputs))
         new_outputs = {k: v for k, v in new_outputs}
 
@@ -174,10 +910,34 @@ class Nodebook(object):
         for val_hash in six.itervalues(invalidated_outputs):
             self.remove_ref(val_hash)
 
-        # invalidate changed outputs
-        invalidated_outputs.update({k: None for k, _ in six.iteritems(new_outputs)})
+        # update the producer index for variables the node stopped or started outputting
+        position = self.positions[node.name]
+        for var in set(node.outputs) - set(outputs):
+            self._remove_producer(var, position)
+        for var in set(outputs) - set(node.outputs):
+            insort(self.producers.setdefault(var, []), position)
+
         node.outputs = outputs
-        node.invalidate_children(invalidated_outputs)
+        self._invalidate_readers(node, set(invalidated_outputs) | set(new_outputs))
+
+    def _invalidate_readers(self, node, variables):
+        """
+        Invalidate nodes after node that read any of variables from it or from an earlier producer it now shadows,
+        along with everything transitively depending on them
+        """
+        position = self.positions[node.name]
+        stale = []
+        for var in variables:
+            for reader_id in self.readers.get(var, ()):
+                reader_position = self.positions[reader_id]
+                if reader_position > position and self.positions[self.sources[reader_id][var]] <= position:
+                    stale.append(reader_id)
+        while stale:
+            stale_node = self.nodes[stale.pop()]
+            # nodes that are already invalid were invalidated along with their dependents
+            if stale_node.valid:
+                stale_node.valid = False
+                stale.extend(self.consumers.get(stale_node.name, ()))
 
     def insert_node_after(self, node_id, parent_id):
         """
@@ -193,47 +953,58 @@ class Nodebook(object):
         # get the parent by id or leave empty
         parent = self.nodes.get(parent_id, None)
 
+        if node.name in self.positions and parent == node.parent and (parent is not None or self.head == node):
+            # node is already in the right place, don't need to do anything
+            return
+
+        # first, extract node from its current position
+        moved = node.name in self.positions
+        self._unplace(node)
+        old_parent = node.parent
+        old_child = node.child
+        if old_parent is not None:
+            old_parent.child = old_child
+        elif self.head == node:
+            self.head = old_child
+        if old_child is not None:
+            old_child.parent = old_parent
+
+        # next, insert node to its new location
+        node.parent = parent
         if parent is None:
             # no parent, node is head
-            if self.head != node:
-                node.child = self.head
-                self.head = node
-        elif parent == node.parent:
-            # node is already in the right place, don't need to do anything
-            pass
+            node.child = self.head
+            self.head = node
         else:
-            # first, extract node from its current position
-            old_parent = node.parent
-            old_child = node.child
-            if old_parent is not None:
-                old_parent.child = old_child
-            if old_child is not None:
-                old_child.parent = old_parent
-
-            # next, insert node to its new location
-            node.parent = parent
-            if parent is not None:
-                # put node in between target parent and parent's old child
-                node.child = parent.child
-                parent.child = node
-                # if node now has a child, set it as child's parent
-                if node.child is not None:
-                    node.child.parent = node
+            # put node in between target parent and parent's old child
+            node.child = parent.child
+            parent.child = node
+        # if node now has a child, set it as child's parent
+        if node.child is not None:
+            node.child.parent = node
+        self._place(node)
+        if moved:
+            # moving a node changes which producers the nodes around it read from
+            self._link_all()
 
     def update_all_prompts(self, ipython_payload_manager):
         """
-        Update prompts for all nodes based on their position in list
+        Update prompts for all nodes based on their position in list, sending only prompts that changed
         """
-        node = self.head
-        index = 1
-        while node is not None:
+        for index, position in enumerate(self.order, 1):
+            node = self.at[position]
             if not node.valid:
                 prompt = "X"
             else:
                 prompt = "N_%d" % index
-            self.update_prompt(node, prompt, ipython_payload_manager)
-            node = node.child
-            index += 1
+            if self.prompts.get(node.name) != prompt:
+                self.update_prompt(node, prompt, ipython_payload_manager)
+                self.prompts[node.name] = prompt
+        if self.emit_stats:
+            for node_id in self.unsent_stats:
+                if node_id in self.nodes:
+                    self.update_stats(self.nodes[node_id], ipython_payload_manager)
+        self.unsent_stats = set()
 
     def update_prompt(self, node, prompt, ipython_payload_manager):
         """
@@ -246,6 +1017,175 @@ class Nodebook(object):
         }
         ipython_payload_manager.write_payload(payload, single=False)
 
+    def update_stats(self, node, ipython_payload_manager):
+        """
+        Use ipython payload manager to send the profile of target node's latest run
+        """
+        stats = self.stats[node.name]
+        payload = {
+            "source": "node_stats",
+            "cell_id": node.name,
+            "stats": stats,
+            "summary": _stats_summary(stats),
+        }
+        ipython_payload_manager.write_payload(payload, single=False)
+
+
+def _assignable(node):
+    """
+    Variables a run of node could assign: names bound by its code and its current outputs
+    """
+    return set(node.compiled_code()['locals']) | set(node.outputs)
+
+
+def _run_detached(code, store, input_hashes, keep_result=False, strict=False, lazy_inputs=False):
+    """
+    Run code in a worker process on inputs loaded from store by hash, putting its outputs into store
+
+    Returns the output hashes, the hash of the result if keep_result, the store entries needed to adopt them,
+    see PickleDict.merge, and the profile of the run
+    """
+    stats = _new_stats()
+    start = timer()
+    bytes_read, bytes_written = store.bytes_read, store.bytes_written
+    node = Node(None)
+    node.code = code
+    input_objs = {}
+    loaders = {}
+    with _timed(stats, 'load'):
+        variables = list(input_hashes)
+        if lazy_inputs:
+            loaders = {var: partial(store.__getitem__, input_hashes[var]) for var in variables}
+        else:
+            input_objs = dict(zip(variables, store.get_many([input_hashes[var] for var in variables])))
+            stats['loaded'] = len(input_objs)
+    res, _, output_hashes = node.run(input_objs, dict(input_hashes), strict=strict, stats=stats,
+                                     hash_many=store.put_many, lazy_inputs=loaders)
+    with _timed(stats, 'store'):
+        res_hash = _put_result(store, res) if keep_result else None
+    keys = set(six.itervalues(output_hashes))
+    if res_hash:
+        keys.add(res_hash)
+    stats['bytes_read'] = store.bytes_read - bytes_read
+    stats['bytes_written'] = store.bytes_written - bytes_written
+    stats['total'] = timer() - start
+    return output_hashes, res_hash, store.entries(keys), stats
+
+
+def _put_result(store, res):
+    """
+    Store the result of a run for memoizing, returning its hash, None for no result or False if it can't be stored
+    """
+    if res is None:
+        return None
+    try:
+        return store.put(res)
+    except Exception:
+        return False
+
+
+def _memo_hashes(entry):
+    hashes = list(six.itervalues(entry['outputs']))
+    if entry['result'] is not None:
+        hashes.append(entry['result'])
+    return hashes
+
+
+def _new_stats():
+    stats = {phase: 0.0 for phase in PHASES}
+    stats.update({counter: 0 for counter in STAT_COUNTERS})
+    stats['total'] = 0.0
+    stats['memo_hit'] = False
+    return stats
+
+
+@contextmanager
+def _timed(stats, phase):
+    start = timer()
+    try:
+        yield
+    finally:
+        stats[phase] += timer() - start
+
+
+def _stats_summary(stats):
+    """
+    One line description of a node run's profile, e.g. for a prompt tooltip
+    """
+    if stats['memo_hit']:
+        return "memoized, restored in %.3fs" % stats['total']
+    return "%.3fs: run %.3fs, load %.3fs, store %.3fs; read %d B, wrote %d B" % (
+        stats['total'], stats['run'], stats['load'], stats['store'], stats['bytes_read'], stats['bytes_written'])
+
+
+# stands in for inputs a run never loaded, which it can still assign
+_UNLOADED = object()
+
+
+class _LazyBuiltins(dict):
+    """
+    Builtins for a run that load inputs on first use
+
+    Names missing from a run's globals are looked up in its builtins, so the first read of an unloaded input lands
+    in __missing__, which loads it into the globals where later reads find it. Builtins shadowed by an input are
+    left out so the input is found instead.
+    """
+
+    def __init__(self, env, loaders, stats):
+        dict.__init__(self, six.moves.builtins.__dict__)
+        for name in loaders:
+            self.pop(name, None)
+        self.env = env
+        self.loaders = dict(loaders)
+        self.stats = stats
+        self.loaded = {}
+
+    def __missing__(self, name):
+        if name not in self.loaders:
+            raise KeyError(name)
+        with _timed(self.stats, 'load'):
+            try:
+                obj = self.loaders.pop(name)()
+            except KeyError:
+                # a KeyError here would be reported as the name being undefined
+                raise LookupError("value of input %s is missing from the store" % name)
+        self.env[name] = self.loaded[name] = obj
+        return obj
+
+
+# bumped whenever the contents of compiled code caches change, see Node.compiled_code
+COMPILED_VERSION = 2
+
+
+def _code_digest(code):
+    return hashlib.md5(code.encode('utf-8')).hexdigest()
+
+
+def _compile(code):
+    """
+    Parse and compile code, splitting off a trailing expression that is evaluated for the result of a run
+
+    Returns the code digest, a digest of the syntax tree, the code objects, and the names referenced by the code
+    """
+    tree = ast.parse(code)
+    rf = ReferenceFinder()
+    rf.visit(tree)
+    compiled = {
+        'version': COMPILED_VERSION,
+        'digest': _code_digest(code),
+        'tree': hashlib.md5(ast.dump(tree).encode('utf-8')).hexdigest(),
+        'inputs': sorted(rf.inputs),
+        'imports': sorted(rf.imports),
+        'locals': sorted(rf.locals),
+        'mutated': sorted(rf.possibly_mutated()),
+        'deferred': sorted(rf.inputs & _deferred_names(tree)),
+        'expr': None,
+    }
+    if len(tree.body) > 0 and type(tree.body[-1]) is ast.Expr:
+        compiled['expr'] = compile(ast.Expression(tree.body.pop().value), '<string>', mode='eval')
+    compiled['block'] = compile(tree, '<string>', mode='exec')
+    return compiled
+
 
 class Node(object):
     def __init__(self, name):
@@ -257,45 +1197,119 @@ class Node(object):
         self.outputs = {}
         self.imports = set()
         self.code = ''
+        self.last_run = None
+
+    @classmethod
+    def deferred(cls, name, load_code):
+        """
+        Create a node whose code, imports and compiled code are only read when first used
+
+        load_code returns a dict of those attributes, see compiled_code
+        """
+        node = cls(name)
+        del node.code
+        del node.imports
+        node._load_code = load_code
+        return node
+
+    @property
+    def code_loaded(self):
+        return '_load_code' not in self.__dict__
+
+    def __getattr__(self, name):
+        # only reached for attributes that aren't set, i.e. code and imports not loaded yet
+        load_code = self.__dict__.get('_load_code')
+        if load_code is None or name not in ('code', 'imports'):
+            raise AttributeError(name)
+        self.__dict__.update(load_code())
+        del self._load_code
+        return self.__dict__[name]
+
+    def __getstate__(self):
+        if not self.code_loaded:
+            self.code
+        state = self.__dict__.copy()
+        state.pop('compiled', None)  # code objects don't pickle
+        return state
+
+    def compiled_code(self):
+        """
+        Return the parsed and compiled form of the node's code, only compiling each version of the code once
+        """
+        digest = _code_digest(self.code)  # loads deferred code first
+        compiled = self.__dict__.get('compiled')
+        if compiled is None or compiled['digest'] != digest or compiled.get('version') != COMPILED_VERSION:
+            compiled = self.compiled = _compile(self.code)
+        return compiled
 
     def update_code(self, code):
         """
         Parse a block of python code for its inputs and assign to this node
         """
         self.code = code
-        tree = ast.parse(code)
-        rf = ReferenceFinder()
-        rf.visit(tree)
-        self.inputs = {x: None for x in rf.inputs}
-        self.imports = rf.imports
+        compiled = self.compiled_code()
+        self.inputs = {x: None for x in compiled['inputs']}
+        self.imports = set(compiled['imports'])
         self.valid = False  # not valid until executed
 
-    def run(self, input_objs, input_hashes):
+    def run(self, input_objs, input_hashes, hash_fn=pickledict.hash, strict=False, stats=None, hash_many=None,
+            lazy_inputs=None):
         """
         Execute this node in the provided environment given hashes of inputs
+
+        hash_fn is applied to every variable left in the environment; passing a store's put method saves
+        the outputs in the same pass that hashes them. If given, hash_many is used instead to hash all of them in
+        one call, e.g. a store's put_many to store them in parallel. Inputs still bound to the same object are only
+        hashed if the code may have modified them in place, see ReferenceFinder.possibly_mutated, unless strict.
+        If a stats dict is given, the time spent running the code and in hash_fn is added to its 'run' and 'store'
+        entries, and the number of values hashed to 'hashed'.
+
+        lazy_inputs optionally maps inputs missing from input_objs to functions loading them, called when the code
+        first reads them. Inputs never read aren't loaded or hashed, and are counted in stats 'untouched', while
+        time spent loading the rest is moved from 'run' to 'load' and they are counted in 'loaded'.
         """
         env = input_objs
+        originals = dict(input_objs)
+        stats = stats if stats is not None else _new_stats()
+        compiled = self.compiled_code()
+        if lazy_inputs:
+            env['__builtins__'] = lazy = _LazyBuiltins(env, lazy_inputs, stats)
+            # functions defined by the code are stored with the inputs they read, so load those now
+            for var in compiled['deferred']:
+                if var in lazy.loaders:
+                    lazy[var]
 
         # if code ends in an expression, execute it as an expression, otherwise execute whole block
-        block = ast.parse(self.code)
-        if len(block.body) > 0 and type(block.body[-1]) is ast.Expr:
-            last = ast.Expression(block.body.pop().value)
-            exec(compile(block, '<string>', mode='exec'), env)
-            res = eval(compile(last, '<string>', mode='eval'), env)
-        else:
-            exec(compile(block, '<string>', mode='exec'), env)
-            res = None
+        load_before = stats['load']
+        with _timed(stats, 'run'):
+            exec(compiled['block'], env)
+            if compiled['expr'] is not None:
+                res = eval(compiled['expr'], env)
+            else:
+                res = None
+        if lazy_inputs:
+            stats['run'] -= stats['load'] - load_before
+            stats['loaded'] += len(lazy.loaded)
+            stats['untouched'] += len(lazy.loaders)
+            originals.update(lazy.loaded)
 
         # find outputs which have changed from input hashes
         self.inputs = input_hashes
         output_objs = {}
         output_hashes = {}
-        for var in [k for k in env.keys() if k != '__builtins__']:
-            val = env[var]
-            val_hash = pickledict.hash(val)
-            if self.inputs.get(var, 0) != val_hash:
-                output_hashes[var] = val_hash
-                output_objs[var] = val
+        mutated = set(compiled['mutated'])
+        if hash_many is None:
+            hash_many = pickledict.hash_many if hash_fn is pickledict.hash else lambda vals: [hash_fn(v) for v in vals]
+        with _timed(stats, 'store'):
+            # inputs only read are unchanged
+            variables = [var for var in env.keys() if var != '__builtins__' and
+                         (strict or var not in self.inputs or var in mutated or
+                          env[var] is not originals.get(var, _UNLOADED))]
+            for var, val_hash in zip(variables, hash_many([env[var] for var in variables])):
+                if self.inputs.get(var, 0) != val_hash:
+                    output_hashes[var] = val_hash
+                    output_objs[var] = env[var]
+            stats['hashed'] += len(variables)
         self.valid = True
         return res, output_objs, output_hashes
 
@@ -303,50 +1317,12 @@ class Node(object):
         """
         Return index of this node
         """
-        if self.parent is None:
-            return 0
-        else:
-            return 1 + self.parent.get_index()
-
-    def invalidate_children(self, outputs):
-        """
-        Invalidate any children of this node that depend on the provided outputs
-        """
-        if len(outputs) == 0:
-            return  # no action for empty outputs
-
-        child = self.child
-        while child is not None:
-            child.invalidate(outputs)
-            child = child.child
-
-    def invalidate(self, inputs=None):
-        """
-        Invalidate node and any children that depend on its outputs
-        Optionally conditional on this node using a specific input variable / hash
-        """
-        # only need to take action if this node _was_ valid
-        if not self.valid:
-            return
-
-        # don't invalidate if input var is specified and is not one of our inputs
-        if inputs is not None:
-            shared_inputs = set(inputs).intersection(self.inputs)
-            if len(shared_inputs) == 0:
-                return
-
-            # also don't invalidate if no specified input hashes match
-            input_match = False
-            for input in shared_inputs:
-                if inputs[input] is None or inputs[input] == self.inputs[input]:
-                    input_match = True
-            if not input_match:
-                return
-
-        self.valid = False
-
-        # also invalidate children that rely on our outputs
-        self.invalidate_children(self.outputs)
+        index = 0
+        node = self.parent
+        while node is not None:
+            index += 1
+            node = node.parent
+        return index
 
     def __str__(self):
         return self.name
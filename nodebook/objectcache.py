@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from .pickledict import pandas_copy_on_write
+
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+
+def _readonly_array(arr):
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+
+def readonly_view(obj):
+    """
+    Return a view of obj that shares its memory but can't modify it, or None if obj isn't supported
+
+    Supports numpy arrays and pandas Series/DataFrames without object columns, whose elements could otherwise
+    be mutated in place. Arrays are flagged read-only; pandas objects rely on copy-on-write if it is enabled,
+    and are otherwise rebuilt around read-only arrays.
+    """
+    obj_type = type(obj)
+    if obj_type is np.ndarray:
+        return None if obj.dtype.hasobject else _readonly_array(obj)
+    if obj_type not in (pd.DataFrame, pd.Series):
+        return None
+
+    columns = [obj] if obj_type is pd.Series else [column for _, column in obj.items()]
+    if any(column.dtype == object for column in columns):
+        return None
+    if pandas_copy_on_write():
+        return obj.copy(deep=False)
+    if any(not isinstance(column.dtype, np.dtype) for column in columns):
+        # extension arrays can't be flagged read-only
+        return None
+
+    if obj_type is pd.Series:
+        return pd.Series(_readonly_array(np.asarray(obj.array)), index=obj.index, name=obj.name, copy=False)
+    view = pd.DataFrame({i: _readonly_array(np.asarray(column.array)) for i, column in enumerate(columns)},
+                        index=obj.index, copy=False)
+    view.columns = obj.columns
+    return view
+
+
+class ObjectCache(object):
+    """
+    Bounded LRU cache of live objects loaded from a PickleDict, keyed by value hash
+
+    Cached objects are shared between reads, so callers must discard any key whose object may have been
+    mutated or may have escaped to code outside of nodebook. Sizes are estimated by serialized size.
+    """
+
+    def __init__(self, store, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        store: PickleDict to load values from
+        max_bytes: budget for cached objects, 0 disables caching
+        """
+        self.store = store
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # live objects are never persisted
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Return the cached object for key, loading it from the store on a miss
+        """
+        if key in self.entries:
+            self.hits += 1
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)  # mark most recently used
+            return value
+
+        self.misses += 1
+        value = self.store[key]
+        self._add(key, value, self.store.size(key))
+        return value
+
+    def _add(self, key, value, size):
+        if size <= self.max_bytes:
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            self._evict(self.max_bytes)
+
+    def get_many(self, keys):
+        """
+        Return the cached objects for keys, loading all misses from the store in parallel, see PickleDict.get_many
+        """
+        missing = [key for key in OrderedDict.fromkeys(keys) if key not in self.entries]
+        loaded = dict(zip(missing, self.store.get_many(missing)))
+        objs = []
+        for key in keys:
+            if key in loaded:
+                self.misses += 1
+                value = loaded.pop(key)
+                self._add(key, value, self.store.size(key))
+                objs.append(value)
+            else:
+                objs.append(self.get(key))
+        return objs
+
+    def discard(self, key):
+        """
+        Drop key from the cache, if present
+        """
+        if key in self.entries:
+            _, size = self.entries.pop(key)
+            self.nbytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget, evicting entries as needed
+        """
+        self.max_bytes = max_bytes
+        self._evict(max_bytes)
+
+    def _evict(self, max_bytes):
+        while self.nbytes > max_bytes:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Summary of cache usage and effectiveness
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
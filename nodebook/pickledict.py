@@ -1,26 +1,35 @@
 from __future__ import absolute_import
-import io
+import atexit
+import copy
+import errno
+import mmap
+import multiprocessing
 import os
+import shutil
+import struct
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import partial
 import hashlib
+import numpy as np
 import pandas as pd
 import msgpack
 import inspect
+import pickle
 import six
 
 # using cloudpickle instead of pickle for more complete serialization
 import cloudpickle
 
-# Use cStringIO if available.
 try:
-    from cStringIO import StringIO
+    from concurrent.futures import ThreadPoolExecutor
 except ImportError:
-    try:
-        from StringIO import StringIO
-    except ImportError:
-        # Python3. We are using StringIO as a target for pickle, so we
-        # actually want BytesIO.
-        from io import BytesIO as StringIO
+    # python 2 needs the futures backport
+    ThreadPoolExecutor = None
 
 try:
     from UserDict import DictMixin
@@ -28,113 +37,1584 @@ except ImportError:
     # see https://github.com/flask-restful/flask-restful/pull/231/files
     from collections.abc import MutableMapping as DictMixin
 
+# xxhash is optional, but much faster than the hashlib digests when installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# pyarrow is optional, enabling the memory-mapped Arrow IPC format for DataFrames in disk mode
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# zstandard and lz4 are optional codecs for compressing .pak files, falling back to zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# file locks coordinate the nodebooks sharing a store, see SharedPickleDict
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 PANDAS_CODE = 1
 CLOUDPICKLE_CODE = 2
+# cloudpickle data referring to large buffers stored out-of-band, after the msgpack data, see _pack
+OUT_OF_BAND_CODE = 3
+
+# pickle protocol 5 (python 3.8+) can hand out the buffers of arrays without copying them into the pickle
+OUT_OF_BAND = pickle.HIGHEST_PROTOCOL >= 5
+# buffers smaller than this stay in the pickle data
+OUT_OF_BAND_MIN_BYTES = 64 * 1024
+
+# content hash backends, by name -- each factory returns a fresh object supporting update() and hexdigest()
+HASHERS = {}
+
+
+def register_hasher(name, factory):
+    """
+    Make a hash backend available to PickleDict and hash() under name
+    """
+    HASHERS[name] = factory
+
+
+def new_hasher(hash_name):
+    """
+    Create a fresh hasher for the named backend
+    """
+    try:
+        factory = HASHERS[hash_name]
+    except KeyError:
+        raise ValueError("Unknown hash backend %r, expected one of %s" % (hash_name, sorted(HASHERS)))
+    return factory()
 
 
-def msgpack_serialize(obj):
+register_hasher('md5', partial(hashlib.new, 'md5'))
+if hasattr(hashlib, 'blake2b'):
+    register_hasher('blake2b', partial(hashlib.blake2b, digest_size=16))
+if xxhash is not None:
+    register_hasher('xxh3', xxhash.xxh3_128)
+
+# hash backend for new stores, fastest available first
+if 'xxh3' in HASHERS:
+    DEFAULT_HASH = 'xxh3'
+elif 'blake2b' in HASHERS:
+    DEFAULT_HASH = 'blake2b'
+else:
+    DEFAULT_HASH = 'md5'
+
+# hash backend assumed for stores created before the backend was recorded
+LEGACY_HASH = 'md5'
+
+
+def _pickle(obj, buffers=None):
+    """
+    cloudpickle obj, appending its large buffers to buffers instead of copying them into the data, if given
+    """
+    if buffers is None or not OUT_OF_BAND:
+        return msgpack.ExtType(CLOUDPICKLE_CODE, cloudpickle.dumps(obj))
+    found = []
+
+    def out_of_band(buf):
+        if buf.raw().nbytes < OUT_OF_BAND_MIN_BYTES:
+            return True
+        found.append(buf.raw())
+        return False
+    data = cloudpickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+    buffers.extend(found)
+    # without large buffers the data is the same as without out-of-band support, keeping the same hash
+    return msgpack.ExtType(OUT_OF_BAND_CODE if found else CLOUDPICKLE_CODE, data)
+
+
+def msgpack_serialize(obj, buffers=None):
     if type(obj) is pd.DataFrame or type(obj) is pd.Series:
         try:
             return msgpack.ExtType(PANDAS_CODE, obj.to_msgpack())
         except:
             # pandas msgpack support is experimental and sometimes fails
-            return msgpack.ExtType(CLOUDPICKLE_CODE, cloudpickle.dumps(obj))
+            return _pickle(obj, buffers)
     else:
         if inspect.isclass(obj):
             # dynamically defined classes default to __builtin__ but are only serializable in __main__
             if obj.__module__ == '__builtin__':
                 obj.__module__ = '__main__'
-        return msgpack.ExtType(CLOUDPICKLE_CODE, cloudpickle.dumps(obj))
+        return _pickle(obj, buffers)
 
 
-def msgpack_deserialize(code, data):
+def msgpack_deserialize(code, data, buffers=None):
+    """
+    buffers: iterator over the out-of-band buffers of the data being loaded, consumed in order
+    """
     if code == PANDAS_CODE:
         return pd.read_msgpack(data)
     elif code == CLOUDPICKLE_CODE:
         return cloudpickle.loads(data)
+    elif code == OUT_OF_BAND_CODE:
+        return cloudpickle.loads(data, buffers=buffers)
     else:
         return msgpack.ExtType(code, data)
 
 
+class _HashingWriter(object):
+    """
+    File-like sink that digests everything written to it, optionally passing the bytes through to another file
+    """
+
+    def __init__(self, hasher, f=None):
+        self.hasher = hasher
+        self.f = f
+
+    def write(self, data):
+        self.hasher.update(data)
+        if self.f is not None:
+            self.f.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+# prefix for structural digests, keeping them disjoint from digests of serialized data
+STRUCTURAL_PREFIX = b'nodebook.structural\0'
+
+
+def _update_meta(hasher, *parts):
+    hasher.update(repr(parts).encode('utf-8'))
+    hasher.update(b'\0')
+
+
+def _hash_ndarray(arr, hasher):
+    """
+    Digest a non-object numpy array through the buffer protocol, returning False for object arrays
+    """
+    if arr.dtype.hasobject:
+        return False
+    if arr.flags.c_contiguous:
+        order, data = 'C', arr
+    elif arr.flags.f_contiguous:
+        order, data = 'F', arr.T
+    else:
+        # strided views are the one case that needs a copy
+        order, data = 'C', np.ascontiguousarray(arr)
+    _update_meta(hasher, 'ndarray', arr.dtype.descr, arr.shape, order)
+    hasher.update(data)
+    return True
+
+
+def _hash_array_values(values, hasher):
+    """
+    Digest the values backing a pandas column or index, falling back to their pickle stream for object data
+    """
+    if isinstance(values, np.ndarray) and _hash_ndarray(values, hasher):
+        return
+    if isinstance(values, pd.Categorical):
+        _update_meta(hasher, 'categorical', values.ordered)
+        _hash_array_values(np.asarray(values.codes), hasher)
+        _hash_index(values.categories, hasher)
+        return
+    _update_meta(hasher, 'pickled', str(values.dtype))
+    cloudpickle.dump(values, _HashingWriter(hasher), protocol=2)
+
+
+def _column_values(obj):
+    """
+    Values backing a Series or Index, unwrapped to an ndarray without copying if its dtype is a numpy one
+    """
+    # decided from obj's own dtype, as obj.array wraps numpy data in an extension array with its own dtype
+    if isinstance(obj.dtype, np.dtype):
+        return np.asarray(obj.array)
+    return obj.array
+
+
+def _hash_index(index, hasher):
+    if type(index) is pd.RangeIndex:
+        _update_meta(hasher, 'range_index', index.name, index.start, index.stop, index.step)
+    elif type(index) is pd.MultiIndex:
+        _update_meta(hasher, 'multi_index', list(index.names), index.nlevels)
+        for level, codes in zip(index.levels, index.codes):
+            _hash_index(level, hasher)
+            _hash_array_values(np.asarray(codes), hasher)
+    else:
+        _update_meta(hasher, 'index', type(index).__name__, index.name, str(index.dtype))
+        _hash_array_values(_column_values(index), hasher)
+
+
+def _hash_series(series, hasher):
+    _update_meta(hasher, 'series', series.name, str(series.dtype))
+    _hash_index(series.index, hasher)
+    _hash_array_values(_column_values(series), hasher)
+
+
+def _hash_frame(df, hasher):
+    _update_meta(hasher, 'frame', df.shape)
+    _hash_index(df.columns, hasher)
+    _hash_index(df.index, hasher)
+    for _, column in df.items():
+        _update_meta(hasher, str(column.dtype))
+        _hash_array_values(_column_values(column), hasher)
+
+
+# exact types with a structural hasher -- subclasses may carry extra state, so they are serialized instead
+STRUCTURAL_HASHERS = {
+    pd.DataFrame: _hash_frame,
+    pd.Series: _hash_series,
+    np.ndarray: _hash_ndarray,
+}
+for index_type in (pd.Index, pd.RangeIndex, pd.MultiIndex, pd.CategoricalIndex, pd.DatetimeIndex,
+                   pd.TimedeltaIndex, pd.PeriodIndex, pd.IntervalIndex):
+    STRUCTURAL_HASHERS[index_type] = _hash_index
+
+
+def _structurally_hashed(obj):
+    """
+    Whether structural_hash applies to obj, without hashing it
+    """
+    return type(obj) in STRUCTURAL_HASHERS and not (type(obj) is np.ndarray and obj.dtype.hasobject)
+
+
+def structural_hash(obj, hash_name=None):
+    """
+    Hash DataFrames, Series, Indexes and non-object numpy arrays directly from their memory buffers
+
+    Returns None for any other object, which must be hashed via its serialized data instead
+    """
+    if not _structurally_hashed(obj):
+        return None
+    hash_structure = STRUCTURAL_HASHERS[type(obj)]
+
+    hasher = new_hasher(hash_name if hash_name is not None else DEFAULT_HASH)
+    hasher.update(STRUCTURAL_PREFIX)
+    hash_structure(obj, hasher)
+    return hasher.hexdigest()
+
+
+def pandas_copy_on_write():
+    """
+    Whether pandas copies shared data before writing to it, which is always the case from pandas 3
+    """
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    return getattr(pd.options.mode, 'copy_on_write', False) is True
+
+
+def snapshot(value):
+    """
+    Copy a structurally hashed value so that later writes to value don't affect it, as cheaply as possible
+
+    Under pandas copy-on-write this shares memory until either side is written to.
+    """
+    if type(value) is np.ndarray:
+        return value.copy()
+    if isinstance(value, pd.Index):
+        return value  # immutable
+    return value.copy(deep=not pandas_copy_on_write())
+
+
+class Serializer(object):
+    """
+    File format for values of particular types in disk mode, used in place of the default msgpack .pak files
+
+    Loads should be cheap views of the file (e.g. memory-mapped) that still behave as private copies.
+    Formats that can't round-trip every accepted value exactly set verify, to check each write by reading it back.
+    """
+    name = None
+    extension = None
+    verify = False
+
+    def accepts(self, obj):
+        raise NotImplementedError
+
+    def dump(self, obj, f):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+    def round_trips(self, obj):
+        """
+        Whether obj is known to load back exactly, so a verified format needn't read it back
+        """
+        return False
+
+
+class NpySerializer(Serializer):
+    """
+    numpy arrays as .npy files, loaded as copy-on-write memory maps
+    """
+    name = 'npy'
+    extension = 'npy'
+
+    def accepts(self, obj):
+        # zero-length files can't be memory-mapped
+        return type(obj) is np.ndarray and not obj.dtype.hasobject and obj.nbytes > 0
+
+    def dump(self, obj, f):
+        np.save(f, obj, allow_pickle=False)
+
+    def load(self, path):
+        # mode 'c' keeps writes private to this process; the plain ndarray view hashes like the original
+        return np.load(path, mmap_mode='c').view(np.ndarray)
+
+
+class ArrowSerializer(Serializer):
+    """
+    DataFrames as Arrow IPC files, read through a memory map and copied out of it, as the mapped columns are
+    read-only
+    """
+    name = 'arrow'
+    extension = 'arrow'
+    verify = True
+
+    def accepts(self, obj):
+        return type(obj) is pd.DataFrame and len(obj.columns) > 0 and obj.columns.is_unique
+
+    def round_trips(self, obj):
+        # numeric and boolean columns named by strings, on a range index
+        return (type(obj.index) is pd.RangeIndex and type(obj.columns) is pd.Index and
+                all(isinstance(name, six.string_types) for name in obj.columns) and
+                all(isinstance(dtype, np.dtype) and dtype.isnative and
+                    (dtype.kind in 'biu' or (dtype.kind == 'f' and dtype.itemsize >= 4)) for dtype in obj.dtypes))
+
+    def dump(self, obj, f):
+        table = pyarrow.Table.from_pandas(obj, preserve_index=None)
+        with pyarrow.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+    def load(self, path):
+        with pyarrow.memory_map(path, 'r') as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+        # the copy is the only one made, and leaves no column on the read-only map
+        return table.to_pandas(split_blocks=True).copy(deep=True)
+
+
+# serializers tried in order for each value stored in disk mode, see register_serializer
+SERIALIZERS = []
+
+
+def register_serializer(serializer):
+    """
+    Store values accepted by serializer in its file format; later registrations take precedence
+    """
+    SERIALIZERS.insert(0, serializer)
+
+
+def serializer_for_path(path):
+    """
+    Find the registered serializer that wrote path, or None for the default msgpack format
+    """
+    extension = os.path.splitext(path)[1][1:]
+    for serializer in SERIALIZERS:
+        if serializer.extension == extension:
+            return serializer
+    return None
+
+
+register_serializer(NpySerializer())
+if pyarrow is not None:
+    import pyarrow.ipc
+    register_serializer(ArrowSerializer())
+
+
+class Codec(object):
+    """
+    Compression format for .pak files
+    """
+
+    def __init__(self, name, compressobj, decompress, default_level=None):
+        """
+        compressobj: factory taking a level (None for the codec default) and returning an object with
+            compress(data) and flush() methods, like zlib.compressobj
+        decompress: function decompressing a complete payload
+        """
+        self.name = name
+        self.compressobj = compressobj
+        self.decompress = decompress
+        self.default_level = default_level
+
+    def compressor(self, level=None):
+        return self.compressobj(self.default_level if level is None else level)
+
+
+class _LZ4Compressor(object):
+    """
+    Adapt lz4's frame compressor to the zlib.compressobj interface
+    """
+
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.flush()
+        return self.compressor.flush()
+
+
+def _zstd_decompress(data):
+    # decompressobj handles streamed frames, which don't record their content size
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+# compression codecs for .pak files by name, see register_codec
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+class _NoCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+register_codec(Codec('none', lambda level: _NoCompressor(), bytes))
+register_codec(Codec('zlib', zlib.compressobj, zlib.decompress, default_level=1))
+if lz4 is not None:
+    register_codec(Codec('lz4', _LZ4Compressor, lz4.frame.decompress, default_level=0))
+if zstandard is not None:
+    register_codec(Codec('zstd', lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+                         _zstd_decompress, default_level=3))
+
+# codec for new disk stores, fastest with a useful ratio first
+if 'zstd' in CODECS:
+    DEFAULT_CODEC = 'zstd'
+elif 'lz4' in CODECS:
+    DEFAULT_CODEC = 'lz4'
+else:
+    DEFAULT_CODEC = 'zlib'
+
+# .pak files with a header start with this magic, followed by the header length and a msgpack header map.
+# The first byte is a complete msgpack value by itself, so it can't begin a longer headerless (legacy) file.
+PAK_MAGIC = b'NBK1'
+PAK_HEADER_LENGTH = struct.Struct('>I')
+# out-of-band buffers follow the header uncompressed, each starting at a multiple of this offset so they can be
+# memory-mapped as aligned arrays, and the header lists their lengths
+SEGMENT_ALIGNMENT = 64
+
+# leading bytes compressed to decide whether a value is worth compressing at all
+COMPRESSION_SAMPLE_BYTES = 256 * 1024
+# compressed/raw size ratio of the sample above which the value is stored uncompressed
+MAX_COMPRESSION_RATIO = 0.9
+
+# background threads writing values in write-behind mode
+DEFAULT_WRITE_WORKERS = 2
+# threads hashing, storing and loading values in batches, see hash_many and PickleDict.put_many
+DEFAULT_BATCH_WORKERS = min(8, multiprocessing.cpu_count())
+
+# Content-defined chunking for chunked stores, see _chunk_ends. A chunk ends where the sum of random gear values
+# of its last CHUNK_WINDOW bytes has its low bits clear, so chunk ends move with the content when bytes are
+# inserted or removed before them, and a slightly changed value shares most chunks with the original.
+CHUNK_WINDOW = 64
+CHUNK_MIN_BYTES = 16 * 1024
+# a power of 2, the average distance between chunk ends before applying the minimum and maximum
+CHUNK_AVG_BYTES = 64 * 1024
+CHUNK_MAX_BYTES = 256 * 1024
+# bytes scanned for chunk ends at a time, bounding the memory used
+CHUNK_SCAN_BYTES = 1024 * 1024
+CHUNK_GEAR = np.random.RandomState(0x6e6264).randint(0, 1 << 32, size=256).astype(np.uint32)
+# subdirectory of a chunked store holding the chunks of its values
+CHUNKS_DIR = 'chunks'
+
+
+def _write_pak_header(f, header):
+    packed = msgpack.packb(header, use_bin_type=True)
+    f.write(PAK_MAGIC)
+    f.write(PAK_HEADER_LENGTH.pack(len(packed)))
+    f.write(packed)
+
+
+def _padding(offset):
+    return -offset % SEGMENT_ALIGNMENT
+
+
+def _read_pak(f):
+    """
+    Read the serialized msgpack payload of a .pak file, decompressing it if needed, and its out-of-band buffers
+
+    Buffers are copy-on-write views of the file mapped into memory, so they are only read when used.
+    """
+    magic = f.read(len(PAK_MAGIC))
+    if magic != PAK_MAGIC:
+        # headerless file, written before codecs were recorded
+        f.seek(0)
+        return f.read(), []
+    header_length, = PAK_HEADER_LENGTH.unpack(f.read(PAK_HEADER_LENGTH.size))
+    header = msgpack.unpackb(f.read(header_length), raw=False)
+    segments = []
+    if header.get('segments'):
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+        offset = f.tell()
+        for length in header['segments']:
+            offset += _padding(offset)
+            segments.append(view[offset:offset + length])
+            offset += length
+        f.seek(offset)
+    return CODECS[header['codec']].decompress(f.read()), segments
+
+
+def _chunk_ends(buf):
+    """
+    End offsets of the content-defined chunks of buf, the last being its length, see CHUNK_WINDOW
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    mask = np.uint32(CHUNK_AVG_BYTES - 1)
+    candidates = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(data), CHUNK_SCAN_BYTES):
+        # the window ending at the first byte scanned starts in the previous block
+        low = max(start - CHUNK_WINDOW, 0)
+        sums = np.cumsum(CHUNK_GEAR[data[low:start + CHUNK_SCAN_BYTES]], dtype=np.uint32)
+        if len(sums) < CHUNK_WINDOW:
+            continue
+        windows = sums[CHUNK_WINDOW - 1:].copy()
+        windows[1:] -= sums[:-CHUNK_WINDOW]
+        ends = np.flatnonzero((windows & mask) == 0) + low + CHUNK_WINDOW
+        candidates.append(ends[ends > start])
+    candidates = np.concatenate(candidates)
+
+    ends = []
+    last = 0
+    while last < len(data):
+        i = np.searchsorted(candidates, last + CHUNK_MIN_BYTES)
+        if i < len(candidates) and candidates[i] - last <= CHUNK_MAX_BYTES:
+            last = int(candidates[i])
+        else:
+            last = min(last + CHUNK_MAX_BYTES, len(data))
+        ends.append(last)
+    return ends
+
+
+class _CodecWriter(object):
+    """
+    File-like sink writing a .pak header and compressed payload to f
+
+    The codec is only applied if a sample from the start of the payload compresses well enough, otherwise the
+    payload is stored raw, and the header records the choice.
+    """
+
+    def __init__(self, f, codec_name, level=None, segments=()):
+        """
+        segments: out-of-band buffers written uncompressed between the header and payload, see _read_pak
+        """
+        self.f = f
+        self.codec = CODECS[codec_name]
+        self.level = level
+        self.segments = segments
+        self.pending = []
+        self.pending_size = 0
+        self.compressor = None
+
+    def write(self, data):
+        if self.compressor is None:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= COMPRESSION_SAMPLE_BYTES:
+                self._start()
+        else:
+            self.f.write(self.compressor.compress(data))
+
+    def _start(self):
+        codec = self.codec
+        if codec.name != 'none':
+            sample, remaining = [], COMPRESSION_SAMPLE_BYTES
+            for data in self.pending:
+                sample.append(memoryview(data)[:remaining])
+                remaining -= len(sample[-1])
+            sample = b''.join(sample)
+            trial = codec.compressor(self.level)
+            compressed_size = len(trial.compress(sample)) + len(trial.flush())
+            if compressed_size > MAX_COMPRESSION_RATIO * len(sample):
+                codec = CODECS['none']
+
+        header = {'codec': codec.name}
+        if self.segments:
+            header['segments'] = [len(segment) for segment in self.segments]
+        _write_pak_header(self.f, header)
+        for segment in self.segments:
+            self.f.write(b'\0' * _padding(self.f.tell()))
+            self.f.write(segment)
+        self.compressor = codec.compressor(self.level)
+        pending, self.pending = self.pending, []
+        for data in pending:
+            self.f.write(self.compressor.compress(data))
+
+    def close(self):
+        """
+        Finish the payload, without closing f
+        """
+        if self.compressor is None:
+            self._start()
+        self.f.write(self.compressor.flush())
+
+
 class PickleDict(DictMixin):
     """
     Dictionary with immutable elements using pickle(cloudpickle), optionally supporting persisting to disk
     """
 
-    def __init__(self, persist_path=None):
+    def __init__(self, persist_path=None, hash_name=None, codec=None, level=None, write_behind=False,
+                 workers=DEFAULT_WRITE_WORKERS, batch_workers=DEFAULT_BATCH_WORKERS, memory_bytes=None,
+                 spill_path=None, chunked=False):
         """
         persist_path: if provided, perform serialization to/from disk to this path
+        hash_name: hash backend used to key values stored with put, defaults to DEFAULT_HASH
+        codec: compression codec for .pak files in disk mode, defaults to DEFAULT_CODEC
+        level: compression level, defaults to the codec's own default
+        write_behind: in disk mode, write and fsync values on background threads, see flush
+        workers: number of background writer threads
+        batch_workers: number of threads for put_many, set_many and get_many, 1 to work in the calling thread
+        memory_bytes: in memory mode, budget for serialized values kept in RAM, spilling the least recently used
+            to files in a temporary directory beyond it, see _spill
+        spill_path: directory to create that temporary directory in, defaults to the system's
+        chunked: in disk mode, store values as content-defined chunks shared between values, see _write_chunked
         """
         self.persist_path = persist_path
-        self.dump = partial(msgpack.dump, default=msgpack_serialize)
-        self.load = partial(msgpack.load, ext_hook=msgpack_deserialize)
+        self.hash_name = hash_name if hash_name is not None else DEFAULT_HASH
+        new_hasher(self.hash_name)  # fail early on an unknown backend
+        self.set_codec(codec if codec is not None else DEFAULT_CODEC, level)
+        if chunked and persist_path is None:
+            raise ValueError("chunked storage requires a persist_path")
+        self.chunked = chunked
         self.dict = {}
+        if write_behind and ThreadPoolExecutor is None:
+            raise ImportError("write_behind requires concurrent.futures")
+        self.write_behind = write_behind
+        self.workers = workers
+        self.batch_workers = batch_workers
+        self.memory_bytes = memory_bytes
+        self.spill_path = spill_path
+        self.spill_dir = None
+        # sizes of the values held in RAM in memory mode, least recently used first
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        # serialized bytes moved by reads and writes, for profiling; writes in the background count once done
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._init_writer()
+
+    def _init_writer(self):
+        self._executor = None
+        self._batch_executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        # references to each chunk from the values stored, read from their manifests when first needed
+        self._chunks = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ('_executor', '_batch_executor', '_pending', '_lock', '_chunks'):
+            state.pop(attr, None)
+        if self._pending:
+            # pending writes haven't chosen their file yet, it is found again on load
+            state['dict'] = dict(self.dict, **{key: None for key in self._pending})
+        return state
+
+    def __setstate__(self, state):
+        # stores pickled before hash backends were recorded were keyed with md5
+        state.setdefault('hash_name', LEGACY_HASH)
+        state.setdefault('codec', DEFAULT_CODEC)
+        state.setdefault('level', None)
+        state.setdefault('write_behind', False)
+        state.setdefault('workers', DEFAULT_WRITE_WORKERS)
+        state.setdefault('batch_workers', DEFAULT_BATCH_WORKERS)
+        state.setdefault('bytes_read', 0)
+        state.setdefault('bytes_written', 0)
+        state.setdefault('memory_bytes', None)
+        state.setdefault('spill_path', None)
+        state.setdefault('spill_dir', None)
+        state.setdefault('chunked', False)
+        if 'resident' not in state:
+            entries = state['dict'] if state.get('persist_path') is None else {}
+            state['resident'] = OrderedDict((key, _entry_size(entry)) for key, entry in six.iteritems(entries))
+            state['resident_bytes'] = sum(six.itervalues(state['resident']))
+        self.__dict__.update(state)
+        self._init_writer()
+        if any(path is None for path in six.itervalues(self.dict)):
+            self._find_unresolved_paths()
+
+    def _scan(self):
+        """
+        Map keys to the value files found in persist_path
+        """
+        extensions = _value_extensions()
+        paths = {}
+        for filename in os.listdir(self.persist_path):
+            key, extension = os.path.splitext(filename)
+            if not filename.startswith('.') and extension[1:] in extensions:
+                paths[key] = os.path.join(self.persist_path, filename)
+        return paths
+
+    def _find_unresolved_paths(self):
+        """
+        Locate files for keys that were still being written when the store was pickled, dropping any that never
+        made it to disk
+        """
+        paths = self._scan()
+        for key, path in list(self.dict.items()):
+            if path is None:
+                if key in paths:
+                    self.dict[key] = paths[key]
+                else:
+                    del self.dict[key]
+
+    def reindex(self):
+        """
+        Rebuild the keys of a disk store from the files in persist_path
+        """
+        if self.persist_path is not None:
+            self.flush()
+            self.dict = self._scan()
+            with self._lock:
+                self._chunks = None
+
+    def subset(self, keys):
+        """
+        Copy of this store holding only keys, e.g. to pass values by hash to another process
+
+        Values put into the copy can be brought back with entries and merge.
+        """
+        self.flush()
+        store = copy.copy(self)
+        store.dict = {key: self.dict[key] for key in keys}
+        store.write_behind = False
+        # the copy's new values go back in RAM, it can't spill files that outlive its process
+        store.memory_bytes = None
+        store.resident = OrderedDict()
+        store.resident_bytes = 0
+        # chunk references are only counted in this process, which could delete a chunk the copy's new values
+        # use before they are merged, so those are written whole
+        store.chunked = False
+        store._chunks = None
+        return store
+
+    def entries(self, keys):
+        """
+        Raw entries for keys, serialized data in memory or file paths on disk, see merge
+        """
+        self.flush()
+        return {key: self.dict[key] for key in keys}
+
+    def merge(self, entries):
+        """
+        Adopt entries of another store with the same configuration, such as a subset written to elsewhere
+        """
+        for key, entry in six.iteritems(entries):
+            if key in self:
+                continue
+            if isinstance(entry, _Spilled):
+                # spilled by this store before the subset was taken, its file is gone if the key was deleted since
+                if os.path.exists(entry.path):
+                    with self._lock:
+                        self.dict[key] = entry
+            elif self.persist_path is None:
+                self._hold(key, entry)
+            else:
+                with self._lock:
+                    if entry.endswith('.cdc') and self._chunks is not None:
+                        # not counted yet, otherwise its manifest was already read with the others
+                        self._count_chunks(_read_manifest(entry), 1)
+                    self.dict[key] = entry
+
+    def remove_temporary_files(self):
+        """
+        Remove temporary files left in persist_path by writes that were interrupted, returning the bytes freed
+        """
+        if self.persist_path is None:
+            return 0
+        self.flush()
+        freed = 0
+        for filename in os.listdir(self.persist_path):
+            if filename.startswith('.') and filename.endswith('.tmp'):
+                path = os.path.join(self.persist_path, filename)
+                freed += os.path.getsize(path)
+                os.remove(path)
+        chunks_path = os.path.join(self.persist_path, CHUNKS_DIR)
+        if os.path.isdir(chunks_path):
+            # chunks of values that were never completely written
+            with self._lock:
+                chunks = self._chunk_refs()
+                for filename in os.listdir(chunks_path):
+                    if os.path.splitext(filename)[0] not in chunks:
+                        path = os.path.join(chunks_path, filename)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+        return freed
+
+    def set_codec(self, codec, level=None):
+        """
+        Compress .pak files written from now on with codec; existing files record their own codec
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec %r, expected one of %s" % (codec, sorted(CODECS)))
+        self.codec = codec
+        self.level = level
 
     def keys(self):
-        return list(self.dict.keys())
+        return list(self.dict.keys()) + [key for key in list(self._pending) if key not in self.dict]
 
     def __len__(self):
-        return len(self.dict)
+        return len(self.keys())
 
     def has_key(self, key):
-        return key in self.dict
+        return key in self
 
     def __contains__(self, key):
-        return key in self.dict
+        return key in self.dict or key in self._pending
 
     def get(self, key, default=None):
-        if key in self.dict:
+        if key in self:
             return self[key]
         return default
 
     def __iter__(self):
-        for key in self.dict:
+        for key in self.keys():
             yield key
 
     def __getitem__(self, key):
+        self._wait(key)
         if self.persist_path is not None:
             path = self.dict[key]
+            if path.endswith('.cdc'):
+                return self._read_chunked(path)
+            serializer = serializer_for_path(path)
+            if serializer is not None:
+                value = serializer.load(path)
+                self._count(read=os.path.getsize(path))
+                return value
             with open(path, 'rb') as f:
-                value = self.load(f, raw=False)
-        else:
-            f = StringIO(self.dict[key])
-            value = self.load(f, raw=False)
-        return value
+                data, segments = _read_pak(f)
+                self._count(read=f.tell())
+            return _unpack(data, segments)
+        entry = self.dict[key]
+        if isinstance(entry, _Spilled):
+            with open(entry.path, 'rb') as f:
+                data, segments = _read_pak(f)
+                self._count(read=f.tell())
+            return _unpack(data, segments)
+        self._touch(key)
+        self._count(read=_entry_size(entry))
+        if isinstance(entry, tuple):
+            # buffers of loaded objects are private copies
+            data, segments = entry[0], [bytearray(segment) for segment in entry[1]]
+            return _unpack(data, segments)
+        return _unpack(entry, [])
 
     def __setitem__(self, key, value):
+        self._set(key, value)
+
+    def _set(self, key, value, digest=None):
+        """
+        Store value under key, given its structural hash as digest if already known
+        """
         if self.persist_path is not None:
-            path = os.path.join(self.persist_path, '%s.pak' % key)
+            if self.write_behind:
+                self._write_behind(key, value, digest)
+            else:
+                self._write_value(key, value, digest=digest)
+        else:
+            entry = _memory_entry(*_pack(value))
+            self._hold(key, entry)
+            self._count(written=_entry_size(entry))
+
+    def __delitem__(self, key):
+        self._wait(key)
+        if self.persist_path is not None:
+            self._remove_value_file(self.dict[key])
+        with self._lock:
+            entry = self.dict.pop(key)
+            if key in self.resident:
+                self.resident_bytes -= self.resident.pop(key)
+        if isinstance(entry, _Spilled):
+            os.remove(entry.path)
+
+    def size(self, key):
+        """
+        Size in bytes of the serialized value stored under key
+        """
+        self._wait(key)
+        if self.persist_path is not None:
+            path = self.dict[key]
+            if path.endswith('.cdc'):
+                return sum(length for part in _read_manifest(path) for _, length in part)
+            return os.path.getsize(path)
+        entry = self.dict[key]
+        return entry.size if isinstance(entry, _Spilled) else _entry_size(entry)
+
+    def _hold(self, key, entry):
+        """
+        Keep a memory mode entry in RAM as the most recently used, then spill any values over memory_bytes
+        """
+        with self._lock:
+            old_entry = self.dict.get(key)
+            self.dict[key] = entry
+            if key in self.resident:
+                self.resident_bytes -= self.resident.pop(key)
+            self.resident[key] = _entry_size(entry)
+            self.resident_bytes += self.resident[key]
+        if isinstance(old_entry, _Spilled):
+            os.remove(old_entry.path)
+        if self.memory_bytes is not None:
+            self._spill()
+
+    def _touch(self, key):
+        with self._lock:
+            if key in self.resident:
+                self.resident[key] = self.resident.pop(key)
+
+    def _spill(self):
+        """
+        Move the least recently used values held in RAM to files until the rest fit in memory_bytes
+
+        Spilled values stay on disk, and are read from their files, until deleted.
+        """
+        while True:
+            with self._lock:
+                if self.resident_bytes <= self.memory_bytes or not self.resident:
+                    return
+                key, size = self.resident.popitem(last=False)
+                self.resident_bytes -= size
+                entry = self.dict[key]
+                if self.spill_dir is None:
+                    self.spill_dir = tempfile.mkdtemp(prefix='nodebook_spill_', dir=self.spill_path)
+                    atexit.register(shutil.rmtree, self.spill_dir, True)
+            data, segments = entry if isinstance(entry, tuple) else (entry, [])
+            path = os.path.join(self.spill_dir, '%s.pak' % key)
             with open(path, 'wb') as f:
-                self.dump(value, f, strict_types=True, use_bin_type=True)
+                stream = _CodecWriter(f, self.codec, self.level, segments)
+                stream.write(data)
+                stream.close()
+            with self._lock:
+                deleted = self.dict.get(key) is not entry
+                if not deleted:
+                    self.dict[key] = _Spilled(path, size)
+            if deleted:
+                os.remove(path)
+
+    def _count(self, read=0, written=0):
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def _map(self, fn, items):
+        """
+        Apply fn to each of items on the batch threads, returning the results in order
+        """
+        if self.batch_workers <= 1 or len(items) < 2 or ThreadPoolExecutor is None:
+            return [fn(item) for item in items]
+        with self._lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers)
+        return list(self._batch_executor.map(fn, items))
+
+    def put_many(self, values):
+        """
+        Put each of values, in parallel, returning their keys in order
+
+        Hashing, compression and file I/O release the GIL, so values with large buffers like arrays and frames
+        are stored concurrently. A value appearing more than once is only stored once.
+        """
+        return _map_unique(partial(self._map, self.put), values)
+
+    def set_many(self, items):
+        """
+        Store each value of a dict under its key, in parallel
+        """
+        self._map(lambda item: self.__setitem__(*item), list(items.items()))
+
+    def get_many(self, keys):
+        """
+        Load the value of each of keys, in parallel, returning them in order
+
+        Each key loads an independent copy, even if keys repeat.
+        """
+        return self._map(self.__getitem__, list(keys))
+
+    def flush(self):
+        """
+        Wait for all pending background writes, raising the first error encountered by any of them
+        """
+        error = None
+        for key in list(self._pending):
+            try:
+                self._wait(key)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def defer(self, fn, *args):
+        """
+        Run fn on the background writer threads, to be waited for by flush
+        """
+        return self._submit(None, fn, *args)
+
+    def _submit(self, key, fn, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                atexit.register(self.flush)
+            future = self._executor.submit(fn, *args)
+            self._pending[future if key is None else key] = future
+        return future
+
+    def _wait(self, key):
+        """
+        Block until any pending write of key completes
+        """
+        future = self._pending.get(key)
+        if future is not None:
+            try:
+                future.result()
+            finally:
+                with self._lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+
+    def _write_behind(self, key, value, digest=None):
+        """
+        Queue a background write of value under key
+
+        Arrays and frames are written from a snapshot, and anything else is serialized before returning, so later
+        changes to value can't leak into the store. Only disk I/O, compression and fsync happen in the background.
+        """
+        self._wait(key)
+        if _structurally_hashed(value):
+            self._submit(key, self._write_value, key, snapshot(value), True, digest)
+        else:
+            data, buffers = _pack(value)
+            self._submit(key, self._write_packed, key, data, [bytes(buf) for buf in buffers])
+
+    def _tmp_path(self):
+        return os.path.join(self.persist_path, '.%s.tmp' % uuid.uuid4().hex)
+
+    def _install(self, key, tmp_path, path):
+        """
+        Move a completely written temporary file into place as the file for key
+        """
+        os.rename(tmp_path, path)
+
+    def _adopt(self, key):
+        """
+        Start holding key if it was already stored by another user of persist_path, see SharedPickleDict
+        """
+        return False
+
+    def _replace(self, key, path):
+        """
+        Point key at a newly written file, removing any file previously stored in a different format
+        """
+        with self._lock:
+            old_path = self.dict.get(key)
             self.dict[key] = path
+        if old_path is not None and old_path != path:
+            self._remove_value_file(old_path)
+
+    def _remove_value_file(self, path):
+        """
+        Remove a value's file, and any of its chunks no other value uses
+        """
+        if path.endswith('.cdc'):
+            # released before the manifest is gone, in case references are first read now
+            self._remove_chunks(_read_manifest(path))
+        os.remove(path)
+
+    def _write_file(self, key, extension, write, fsync=False):
+        """
+        Atomically create the file for key, with contents written to an open file by write(f)
+        """
+        tmp_path = self._tmp_path()
+        try:
+            with open(tmp_path, 'wb') as f:
+                write(f)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                size = f.tell()
+            path = os.path.join(self.persist_path, '%s.%s' % (key, extension))
+            self._install(key, tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._replace(key, path)
+        self._count(written=size)
+
+    def _write_value(self, key, value, fsync=False, digest=None):
+        if not self.chunked:
+            for serializer in SERIALIZERS:
+                if serializer.accepts(value) and self._write_with(serializer, key, value, fsync, digest):
+                    return
+
+        self._write_packed(key, *_pack(value), fsync=fsync)
+
+    def _write_packed(self, key, data, buffers=(), fsync=True):
+        if self.chunked:
+            self._write_chunked(key, data, buffers, fsync)
         else:
-            f = StringIO()
-            self.dump(value, f, strict_types=True, use_bin_type=True)
-            serialized = f.getvalue()
-            self.dict[key] = serialized
+            self._write_pak_bytes(key, data, buffers, fsync)
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.persist_path, CHUNKS_DIR, '%s.pak' % chunk)
+
+    def _write_chunked(self, key, data, buffers=(), fsync=True):
+        """
+        Store serialized data and its out-of-band buffers as content-defined chunks, see _chunk_ends
+
+        Each distinct chunk is compressed into its own file under chunks/, named by its hash, and only written if
+        no other value has it already. The value's file is a .cdc manifest listing the hashes and lengths of the
+        chunks of the data and of each buffer.
+        """
+        manifest = []
+        views = {}
+        for part in [data] + list(buffers):
+            view = memoryview(part)
+            chunks = []
+            start = 0
+            for end in _chunk_ends(view):
+                hasher = new_hasher(self.hash_name)
+                hasher.update(view[start:end])
+                chunk = hasher.hexdigest()
+                views[chunk] = view[start:end]
+                chunks.append([chunk, end - start])
+                start = end
+            manifest.append(chunks)
+
+        old_path = self.dict.get(key)
+        old_manifest = _read_manifest(old_path) if old_path is not None and old_path.endswith('.cdc') else None
+        # referenced before writing, so no other value's delete can remove them in the meantime
+        self._add_chunks(manifest)
+        try:
+            if not os.path.isdir(os.path.join(self.persist_path, CHUNKS_DIR)):
+                os.makedirs(os.path.join(self.persist_path, CHUNKS_DIR))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        try:
+            for chunk, view in six.iteritems(views):
+                if not os.path.exists(self._chunk_path(chunk)):
+                    self._write_chunk(chunk, view, fsync)
+            self._write_file(key, 'cdc', lambda f: f.write(msgpack.packb(manifest, use_bin_type=True)), fsync)
+        except BaseException:
+            self._remove_chunks(manifest)
+            raise
+        if old_manifest is not None:
+            self._remove_chunks(old_manifest)
+
+    def _write_chunk(self, chunk, view, fsync=True):
+        tmp_path = self._tmp_path()
+        try:
+            with open(tmp_path, 'wb') as f:
+                stream = _CodecWriter(f, self.codec, self.level)
+                stream.write(view)
+                stream.close()
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                size = f.tell()
+            os.rename(tmp_path, self._chunk_path(chunk))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._count(written=size)
+
+    def _read_chunked(self, path):
+        parts = []
+        for chunks in _read_manifest(path):
+            part = bytearray(sum(length for _, length in chunks))
+            offset = 0
+            for chunk, length in chunks:
+                with open(self._chunk_path(chunk), 'rb') as f:
+                    payload, _ = _read_pak(f)
+                    self._count(read=f.tell())
+                part[offset:offset + length] = payload
+                offset += length
+            parts.append(part)
+        return _unpack(parts[0], parts[1:])
+
+    def _chunk_refs(self):
+        """
+        Map each chunk to the number of references to it from stored values and its length, with _lock held
+        """
+        if self._chunks is None:
+            self._chunks = {}
+            for filename in os.listdir(self.persist_path):
+                if not filename.startswith('.') and filename.endswith('.cdc'):
+                    self._count_chunks(_read_manifest(os.path.join(self.persist_path, filename)), 1)
+        return self._chunks
+
+    def _count_chunks(self, manifest, change):
+        for chunks in manifest:
+            for chunk, length in chunks:
+                refs = self._chunks.setdefault(chunk, [0, length])
+                refs[0] += change
+
+    def _add_chunks(self, manifest):
+        with self._lock:
+            self._chunk_refs()
+            self._count_chunks(manifest, 1)
+
+    def _remove_chunks(self, manifest):
+        """
+        Drop a value's references to its chunks, removing the files of those no value uses anymore
+        """
+        with self._lock:
+            refs = self._chunk_refs()
+            self._count_chunks(manifest, -1)
+            for chunks in manifest:
+                for chunk, _ in chunks:
+                    if chunk in refs and refs[chunk][0] <= 0:
+                        del refs[chunk]
+                        if os.path.exists(self._chunk_path(chunk)):
+                            os.remove(self._chunk_path(chunk))
+
+    def chunk_stats(self):
+        """
+        Deduplication of chunked values: the number of values and distinct chunks, the bytes of the values before
+        deduplication, the bytes of their distinct chunks, the bytes those take on disk once compressed, and the
+        ratio of value bytes to distinct chunk bytes
+        """
+        self.flush()
+        with self._lock:
+            refs = dict(self._chunk_refs()) if self.persist_path is not None else {}
+        value_bytes = sum(count * length for count, length in six.itervalues(refs))
+        chunk_bytes = sum(length for _, length in six.itervalues(refs))
+        return {
+            'values': sum(1 for path in six.itervalues(self.dict) if path.endswith('.cdc'))
+            if self.persist_path is not None else 0,
+            'chunks': len(refs),
+            'value_bytes': value_bytes,
+            'chunk_bytes': chunk_bytes,
+            'stored_bytes': sum(os.path.getsize(self._chunk_path(chunk)) for chunk in refs),
+            'dedup_ratio': float(value_bytes) / chunk_bytes if chunk_bytes else 1.0,
+        }
+
+    def _write_pak_bytes(self, key, data, buffers=(), fsync=True):
+        def write(f):
+            stream = _CodecWriter(f, self.codec, self.level, buffers)
+            stream.write(data)
+            stream.close()
+        self._write_file(key, 'pak', write, fsync)
+
+    def _write_with(self, serializer, key, value, fsync=False, digest=None):
+        """
+        Store value in serializer's format, returning False if it can't represent value faithfully
+
+        Verified formats must load a value with the same structural hash, so loads are indistinguishable
+        from the original. digest is the structural hash of value, if already known; values the format is known
+        to round-trip aren't read back at all.
+        """
+        def write(f):
+            serializer.dump(value, f)
+            if serializer.verify and not serializer.round_trips(value):
+                f.flush()
+                expected = digest if digest is not None else structural_hash(value, self.hash_name)
+                if expected is None or structural_hash(serializer.load(f.name), self.hash_name) != expected:
+                    raise _Unfaithful()
+
+        try:
+            self._write_file(key, serializer.extension, write, fsync)
+        except Exception:
+            # e.g. pyarrow rejecting columns of mixed python objects -- fall back to the default format
+            return False
+        return True
+
+    def put(self, value):
+        """
+        Serialize value once, storing it under the hash of its serialized data, and return the hash
+
+        Values with a structural hash are keyed without serializing, and only serialized if not already stored.
+        Large buffers pickled out-of-band are hashed and written straight from the value's memory, see _pack.
+        """
+        key = structural_hash(value, self.hash_name)
+        if key is not None:
+            if key not in self and not self._adopt(key):
+                self._set(key, value, digest=key)
+            return key
+
+        data, buffers = _pack(value)
+        key = _digest(new_hasher(self.hash_name), data, buffers)
+        if key in self or self._adopt(key):
+            return key
+        if self.persist_path is None:
+            entry = _memory_entry(data, buffers)
+            self._hold(key, entry)
+            self._count(written=_entry_size(entry))
+        elif self.write_behind:
+            self._submit(key, self._write_packed, key, data, [bytes(buf) for buf in buffers])
+        else:
+            self._write_packed(key, data, buffers, fsync=False)
+        return key
+
+
+def _map_unique(map_fn, values):
+    """
+    Apply map_fn, a function mapping a list, to the distinct objects in values, returning a result for each value
+    """
+    unique = OrderedDict((id(value), value) for value in values)
+    results = dict(zip(unique, map_fn(list(unique.values()))))
+    return [results[id(value)] for value in values]
+
+
+def _value_extensions():
+    return {'pak', 'cdc'}.union(serializer.extension for serializer in SERIALIZERS)
+
+
+def _read_manifest(path):
+    """
+    Lists of the [hash, length] of each chunk of a chunked value's data and out-of-band buffers
+    """
+    with open(path, 'rb') as f:
+        return msgpack.unpackb(f.read(), raw=False)
+
+
+# subdirectory of a shared store holding a directory of key markers per store using it
+REFS_DIR = 'refs'
+LOCK_FILE = '.lock'
+
+
+class SharedPickleDict(PickleDict):
+    """
+    Disk store in a directory shared by several nodebooks, possibly in different kernels, storing each value once
+
+    Each store marks the keys it holds with an empty file in refs/<owner>, and a value's file is only deleted when
+    no store holds it anymore. A store marks a key before moving its file into place or adopting a file another
+    store wrote, and markers are checked before deleting, under a lock on the directory. So a value can't be
+    deleted while another store picks it up, and readers never see a partially written file.
+    """
+
+    def __init__(self, persist_path, owner=None, **kwargs):
+        """
+        persist_path: directory shared by the stores
+        owner: name for this store's references, unique among the stores sharing persist_path, defaults to random
+        kwargs: see PickleDict
+        """
+        if fcntl is None:
+            raise ImportError("shared stores require fcntl")
+        if kwargs.get('chunked'):
+            raise ValueError("shared stores can't be chunked")
+        super(SharedPickleDict, self).__init__(persist_path, **kwargs)
+        self.owner = owner if owner is not None else uuid.uuid4().hex
+        try:
+            os.makedirs(os.path.join(persist_path, REFS_DIR, self.owner))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        """
+        Hold the lock of the shared directory, shared by stores adding values and exclusive for deletes
+        """
+        with open(os.path.join(self.persist_path, LOCK_FILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _marker(self, key, owner=None):
+        return os.path.join(self.persist_path, REFS_DIR, owner if owner is not None else self.owner, key)
+
+    def _claimed(self, key, owners=None):
+        if owners is None:
+            owners = os.listdir(os.path.join(self.persist_path, REFS_DIR))
+        return any(os.path.exists(self._marker(key, owner)) for owner in owners)
+
+    def _value_files(self, key):
+        paths = [os.path.join(self.persist_path, '%s.%s' % (key, extension)) for extension in _value_extensions()]
+        return [path for path in paths if os.path.exists(path)]
+
+    def _tmp_path(self):
+        # prefixed by owner, so cleaning up interrupted writes leaves other stores' writes alone
+        return os.path.join(self.persist_path, '.%s.%s.tmp' % (self.owner, uuid.uuid4().hex))
+
+    def _install(self, key, tmp_path, path):
+        with self._locked():
+            open(self._marker(key), 'a').close()
+            os.rename(tmp_path, path)
+
+    def _adopt(self, key):
+        with self._locked():
+            paths = self._value_files(key)
+            if not paths:
+                return False
+            open(self._marker(key), 'a').close()
+        with self._lock:
+            self.dict[key] = paths[0]
+        return True
+
+    def _replace(self, key, path):
+        # other stores may be reading a file in another format, which is left until the value is deleted
+        with self._lock:
+            self.dict[key] = path
+
+    def _scan(self):
+        """
+        Map the keys this store holds to their value files
+        """
+        paths = {}
+        for key in os.listdir(os.path.join(self.persist_path, REFS_DIR, self.owner)):
+            files = self._value_files(key)
+            if files:
+                paths[key] = files[0]
+        return paths
 
     def __delitem__(self, key):
-        if self.persist_path is not None:
-            os.remove(self.dict[key])
+        self._wait(key)
+        with self._locked(exclusive=True):
+            try:
+                os.remove(self._marker(key))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+            if not self._claimed(key):
+                for path in self._value_files(key):
+                    os.remove(path)
         del self.dict[key]
 
+    def remove_temporary_files(self):
+        """
+        Clean up after this store's interrupted writes and any store's interrupted deletes, returning the bytes freed
+
+        Removes this store's temporary files, its markers of values that were never written, and value files no
+        store holds.
+        """
+        self.flush()
+        freed = 0
+        extensions = _value_extensions()
+        with self._locked(exclusive=True):
+            for key in os.listdir(os.path.join(self.persist_path, REFS_DIR, self.owner)):
+                if not self._value_files(key):
+                    os.remove(self._marker(key))
+            owners = os.listdir(os.path.join(self.persist_path, REFS_DIR))
+            for filename in os.listdir(self.persist_path):
+                path = os.path.join(self.persist_path, filename)
+                key, extension = os.path.splitext(filename)
+                if filename.startswith('.'):
+                    unused = filename.startswith('.%s.' % self.owner) and filename.endswith('.tmp')
+                else:
+                    unused = extension[1:] in extensions and not self._claimed(key, owners)
+                if unused:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        return freed
 
-def hash(obj, hash_name='md5'):
+
+class _Unfaithful(Exception):
     """
-    get a hash of a python object based on its serialized data
+    Raised when a serializer can't reproduce a value exactly
+    """
+
+
+def _pack(obj):
     """
-    # TODO: avoid the double-serialization of pickling both for hashing and storage -- can accomplish by refactoring a hash&store method into pickledict
-    # TODO OR find a faster way to hash?
-    stream = io.BytesIO()
-    dump = partial(msgpack.dump, default=msgpack_serialize)
-    hasher = hashlib.new(hash_name)
+    Serialize obj to msgpack data with the storage settings, annotating any failure with the offending object
 
+    Returns the data and the large buffers of pickled objects in it, as views of their memory, which are left out
+    of the data so they are never copied while serializing, see _unpack
+    """
+    buffers = []
     try:
-        dump(obj, stream)
+        data = msgpack.packb(obj, default=partial(msgpack_serialize, buffers=buffers), strict_types=True,
+                             use_bin_type=True)
     except Exception as e:
         e.args += ('Exception while hashing %r: %r' % (obj, e),)
         raise
+    return data, buffers
+
+
+def _unpack(data, buffers):
+    """
+    Load msgpack data serialized by _pack, rebuilding pickled objects around buffers instead of copying them
+    """
+    return msgpack.unpackb(data, raw=False, ext_hook=partial(msgpack_deserialize, buffers=iter(buffers)))
+
+
+# length prefix for each out-of-band buffer hashed, see _digest
+SEGMENT_LENGTH = struct.Struct('>Q')
 
-    dumps = stream.getvalue()
-    hasher.update(dumps)
+
+def _digest(hasher, data, buffers):
+    hasher.update(data)
+    for buf in buffers:
+        hasher.update(SEGMENT_LENGTH.pack(len(buf)))
+        hasher.update(buf)
     return hasher.hexdigest()
+
+
+class _Spilled(object):
+    """
+    Entry for a memory mode value spilled to a file, with the size of its serialized data
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+
+def _memory_entry(data, buffers):
+    """
+    Entry for serialized data in a memory store, copying its buffers
+    """
+    if not buffers:
+        return data
+    return data, [bytes(buf) for buf in buffers]
+
+
+def _entry_size(entry):
+    if isinstance(entry, tuple):
+        return len(entry[0]) + sum(len(segment) for segment in entry[1])
+    return len(entry)
+
+
+# thread pools for hash_many, by number of workers
+_HASH_EXECUTORS = {}
+
+
+def hash_many(objs, hash_name=None, workers=DEFAULT_BATCH_WORKERS):
+    """
+    Hash each of objs, in parallel on up to workers threads, returning the hashes in order, see hash
+    """
+    hash_one = partial(hash, hash_name=hash_name)
+
+    def hash_unique(unique):
+        if workers <= 1 or len(unique) < 2 or ThreadPoolExecutor is None:
+            return [hash_one(obj) for obj in unique]
+        if workers not in _HASH_EXECUTORS:
+            _HASH_EXECUTORS[workers] = ThreadPoolExecutor(max_workers=workers)
+        return list(_HASH_EXECUTORS[workers].map(hash_one, unique))
+    return _map_unique(hash_unique, list(objs))
+
+
+def hash(obj, hash_name=None):
+    """
+    get a hash of a python object based on its serialized data
+
+    Serialization matches PickleDict storage, so the result equals the key PickleDict.put would assign with
+    the same hash backend. Large buffers inside pickled objects are digested in place without copying.
+    pandas and numpy objects are hashed from their memory buffers instead, see structural_hash.
+    """
+    key = structural_hash(obj, hash_name)
+    if key is not None:
+        return key
+    data, buffers = _pack(obj)
+    return _digest(new_hasher(hash_name if hash_name is not None else DEFAULT_HASH), data, buffers)
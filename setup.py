@@ -19,9 +19,15 @@ setup(
         'click',
         'cloudpickle',
         'msgpack-python',
+        'numpy',
         'pandas',
+        'futures; python_version < "3"',
         'pytest-runner',
     ],
+    extras_require={
+        'fast': ['xxhash', 'zstandard'],
+        'arrow': ['pyarrow'],
+    },
     tests_require=['pytest'],
     package_data={
         'nodebook': ['ipython/nbextensions/*.js']
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+import os
+import pytest
+from nodebook import nodebookcore
+from nodebook.nodebookcore import Nodebook
+from nodebook.pickledict import PickleDict
+from nodebook import journal as journal_module
+from nodebook.journal import Journal, COMPACT_MIN_RECORDS
+
+
+def make_nodebook(tmpdir):
+    nb = Nodebook(PickleDict(str(tmpdir)))
+    nb.insert_node_after('a', None)
+    nb.update_code('a', "x = 3\ny = [1, 2]")
+    nb.run_node('a')
+    nb.insert_node_after('b', 'a')
+    nb.update_code('b', "x = x + 1")
+    nb.run_node('b')
+    return nb
+
+
+class TestJournal(object):
+    @pytest.fixture()
+    def nb(self, tmpdir):
+        return make_nodebook(tmpdir)
+
+    @pytest.fixture()
+    def journal(self, tmpdir, nb):
+        journal = Journal(str(tmpdir))
+        journal.replace(journal.snapshot(nb))
+        return journal
+
+    def test_round_trip(self, tmpdir, nb, journal):
+        loaded = Journal(str(tmpdir)).load()
+        assert set(loaded.nodes) == {'a', 'b'}
+        assert loaded.head.name == 'a'
+        assert loaded.nodes['b'].parent is loaded.nodes['a']
+        assert loaded.nodes['a'].child is loaded.nodes['b']
+        assert loaded.nodes['b'].code == "x = x + 1"
+        assert loaded.nodes['b'].outputs == nb.nodes['b'].outputs
+        assert loaded.refcount == nb.refcount
+        assert loaded.variables[loaded.nodes['b'].outputs['x']] == 4
+
+    def test_appends_only_changes(self, nb, journal):
+        assert journal.diff(nb) == b''
+        nb.update_code('b', "x = x + 2")
+        size = os.path.getsize(journal.path)
+        records = journal.records
+        journal.commit(nb)()
+        # new code for b, and b's state since it was invalidated
+        assert journal.records == records + 2
+        assert os.path.getsize(journal.path) > size
+
+    def test_replays_latest(self, tmpdir, nb, journal):
+        nb.update_code('b', "x = x + 2")
+        nb.run_node('b')
+        journal.commit(nb)()
+        loaded = Journal(str(tmpdir)).load()
+        assert loaded.nodes['b'].code == "x = x + 2"
+        assert loaded.variables[loaded.nodes['b'].outputs['x']] == 5
+
+    def test_torn_tail(self, tmpdir, nb, journal):
+        size = os.path.getsize(journal.path)
+        nb.update_code('b', "x = x + 2")
+        journal.commit(nb)()
+        with open(journal.path, 'r+b') as f:
+            f.truncate(os.path.getsize(journal.path) - 3)
+        loaded = Journal(str(tmpdir)).load()
+        assert os.path.getsize(journal.path) >= size
+        assert loaded.nodes['b'].code in ("x = x + 1", "x = x + 2")
+        assert loaded.nodes['a'].code == "x = 3\ny = [1, 2]"
+
+    def test_compaction(self, tmpdir, nb, journal):
+        for i in range(COMPACT_MIN_RECORDS):
+            nb.update_code('b', "x = x + %d" % i)
+            journal.commit(nb)()
+        assert journal.records <= COMPACT_MIN_RECORDS
+        loaded = Journal(str(tmpdir)).load()
+        assert loaded.nodes['b'].code == "x = x + %d" % (COMPACT_MIN_RECORDS - 1)
+
+    def test_lazy_code(self, tmpdir, nb, journal):
+        loaded = Journal(str(tmpdir)).load()
+        assert not loaded.nodes['a'].code_loaded
+        assert loaded.nodes['a'].imports == set()
+        assert loaded.nodes['a'].code_loaded
+        assert not loaded.nodes['b'].code_loaded
+        res, objs = loaded.run_node('b')
+        assert objs == {'x': 4}
+        assert loaded.nodes['b'].code_loaded
+
+    def test_lazy_code_survives_compaction(self, tmpdir, nb, journal):
+        reloaded = Journal(str(tmpdir))
+        loaded = reloaded.load()
+        assert reloaded.diff(loaded) == b''
+        reloaded.replace(reloaded.snapshot(loaded))
+        loaded = Journal(str(tmpdir)).load(lazy=False)
+        assert loaded.nodes['a'].code == "x = 3\ny = [1, 2]"
+        assert loaded.nodes['b'].code == "x = x + 1"
+
+    def test_memo(self, tmpdir, nb):
+        nb.memoize = True
+        nb.update_code('b', "x = x + 2")
+        nb.run_node('b')
+        journal = Journal(str(tmpdir))
+        journal.replace(journal.snapshot(nb))
+        nb.update_code('b', "x = x + 3")
+        nb.run_node('b')
+        journal.commit(nb)()
+
+        loaded = Journal(str(tmpdir)).load()
+        assert list(loaded.memo) == list(nb.memo)
+        assert loaded.refcount == nb.refcount
+        loaded.update_code('b', "x = x + 2")
+        res, objs = loaded.run_node('b')
+        assert objs == {'x': 5}
+
+    def test_compiled_code(self, tmpdir, nb, journal, monkeypatch):
+        compiles = []
+        compile_code = nodebookcore._compile
+        monkeypatch.setattr(nodebookcore, '_compile', lambda code: compiles.append(code) or compile_code(code))
+        loaded = Journal(str(tmpdir)).load()
+        loaded.run_node('b')
+        assert compiles == []
+
+        # code compiled by another python version is compiled again
+        monkeypatch.setattr(journal_module, 'MAGIC_NUMBER', b'\0\0\0\0')
+        loaded = Journal(str(tmpdir)).load()
+        loaded.run_node('b')
+        assert compiles == ["x = x + 1"]
+
+    def test_syntax_error(self, tmpdir, nb, journal):
+        with pytest.raises(SyntaxError):
+            nb.update_code('b', "x = ")
+        journal.commit(nb)()
+        loaded = Journal(str(tmpdir)).load()
+        assert loaded.nodes['b'].code == "x = "
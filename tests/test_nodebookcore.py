@@ -1,9 +1,13 @@
 from __future__ import absolute_import
+import numpy as np
 import pandas as pd
 import pytest
+from nodebook import nodebookcore
 from nodebook.nodebookcore import ReferenceFinder, Nodebook, Node
+from nodebook import pickledict
 from nodebook.pickledict import PickleDict
 import ast
+import pickle
 
 
 class TestReferenceFinder(object):
@@ -32,6 +36,30 @@ class TestReferenceFinder(object):
         assert rf.imports == {'numpy'}
         assert rf.locals == {'np'}
 
+    def test_mutated(self, rf):
+        code_tree = ast.parse(
+            "a[0] = 1\n"
+            "b.x = 2\n"
+            "c.append(3)\n"
+            "d += 4\n"
+            "e.drop('x', inplace=True)\n"
+            "np.add(1, 2, out=g)\n"
+            "f(h)\n"
+            "k = j.T\n"
+            "k[0] = 5\n"
+            "for row in m:\n"
+            "    row.sort()\n"
+            "y = len(n) + o.sum() + p.drop('x') + np.mean(q)\n"
+            "mylib.fn(r)\n"
+            "operator.setitem(s, 0, 1)\n"
+            "np.add.at(t, idx, 1)\n"
+            "f(*u)\n"
+            "z = np.log(v) + pd.concat([w, w2])\n"
+        )
+        rf.visit(code_tree)
+        assert rf.possibly_mutated() == {'a', 'b', 'c', 'd', 'e', 'g', 'h', 'k', 'j', 'row', 'm', 'np', 'pd', 'mylib', 'r',
+                                         'operator', 's', 't', 'idx', 'u'}
+
     def test_multiline(self, rf):
         code_tree = ast.parse(
             "import pandas as pd\n"
@@ -109,3 +137,716 @@ class TestNodebook(object):
         res, objs = nb.run_node(node_id3)
         assert res == 11
         assert objs == {}
+
+
+class TestCompiledCode(object):
+    def test_compiled_once(self, monkeypatch):
+        compiles = []
+        compile_code = nodebookcore._compile
+        monkeypatch.setattr(nodebookcore, '_compile', lambda code: compiles.append(code) or compile_code(code))
+        nb = Nodebook(PickleDict())
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = 42\nx + 1")
+        assert nb.run_node('111')[0] == 43
+        assert nb.run_node('111')[0] == 43
+        assert len(compiles) == 1
+        nb.update_code('111', "x = 42\nx + 2")
+        assert nb.run_node('111')[0] == 44
+        assert len(compiles) == 2
+
+    def test_pickle(self):
+        node = Node('111')
+        node.update_code("x = 1")
+        node = pickle.loads(pickle.dumps(node))
+        assert node.compiled_code()['locals'] == ['x']
+
+
+class TestChangeDetection(object):
+    @pytest.fixture()
+    def hashed(self):
+        return []
+
+    def run(self, code, hashed, strict=False):
+        node = Node('111')
+        node.update_code(code)
+        inputs = {'x': [1, 2], 'y': [3]}
+        input_hashes = {var: pickledict.hash(val) for var, val in inputs.items()}
+
+        def hash_fn(val):
+            hashed.append(val)
+            return pickledict.hash(val)
+        return node.run(inputs, input_hashes, hash_fn=hash_fn, strict=strict)
+
+    def test_read_inputs_skipped(self, hashed):
+        res, objs, hashes = self.run("z = len(x) + len(y)", hashed)
+        assert objs == {'z': 3}
+        assert hashed == [3]
+
+    def test_mutation_hashed(self, hashed):
+        res, objs, hashes = self.run("v = x\nv.append(3)\nz = len(y)", hashed)
+        assert objs == {'v': [1, 2, 3], 'x': [1, 2, 3], 'z': 1}
+        assert len(hashed) == 3
+
+    def test_rebound(self, hashed):
+        res, objs, hashes = self.run("y = [3]", hashed)
+        assert objs == {}
+        assert hashed == [[3]]
+
+    def test_strict(self, hashed):
+        res, objs, hashes = self.run("z = len(x) + len(y)", hashed, strict=True)
+        assert objs == {'z': 3}
+        assert len(hashed) == 3
+
+
+class TestNodeIndex(object):
+    @pytest.fixture()
+    def nb(self):
+        return Nodebook(PickleDict())
+
+    def check_index(self, nb):
+        # positions follow list order, and producers match node outputs
+        node, order = nb.head, []
+        while node is not None:
+            order.append(node)
+            node = node.child
+        assert [nb.at[p] for p in nb.order] == order
+        for var, positions in nb.producers.items():
+            assert positions == sorted(nb.positions[n.name] for n in order if var in n.outputs)
+
+    def test_long_chain(self, nb):
+        parent = None
+        for i in range(2000):
+            nb.insert_node_after(str(i), parent)
+            nb.update_code(str(i), "y = len([1])" if i else "x = 1")
+            parent = str(i)
+        nb.run_node('0')
+        nb.insert_node_after('last', parent)
+        nb.update_code('last', "x")
+        res, objs = nb.run_node('last')
+        assert res == 1
+        assert nb.get_index(nb.nodes['last']) == 2000
+        assert nb.nodes['last'].get_index() == 2000
+
+    def test_move_to_head(self, nb):
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = 1")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "x = 2")
+        nb.run_node('222')
+        nb.insert_node_after('222', None)
+        assert nb.head.name == '222'
+        assert nb.nodes['111'].parent is nb.nodes['222']
+        self.check_index(nb)
+
+        nb.insert_node_after('333', '111')
+        nb.update_code('333', "x")
+        res, objs = nb.run_node('333')
+        assert res == 1
+
+    def test_relabel(self, nb):
+        nb.insert_node_after('a', None)
+        nb.update_code('a', "x = 0")
+        nb.run_node('a')
+        nb.insert_node_after('z', 'a')
+        nb.update_code('z', "x")
+        # repeatedly splitting the same gap eventually exhausts it
+        for i in range(30):
+            nb.insert_node_after(str(i), 'a')
+            nb.update_code(str(i), "x = %d" % (i + 1))
+            nb.run_node(str(i))
+        self.check_index(nb)
+        res, objs = nb.run_node('z')
+        assert res == 1
+
+    def test_prompts_only_changed(self, nb):
+        payloads = []
+
+        class PayloadManager(object):
+            def write_payload(self, payload, single=False):
+                payloads.append(payload)
+
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = 1")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "x")
+        nb.run_node('222')
+        nb.update_all_prompts(PayloadManager())
+        assert len(payloads) == 2
+        nb.update_all_prompts(PayloadManager())
+        assert len(payloads) == 2
+
+        nb.update_code('222', "x + 1")
+        nb.update_all_prompts(PayloadManager())
+        assert payloads[-1] == {"source": "set_prompt", "cell_id": "222", "prompt": "X"}
+        assert len(payloads) == 3
+
+
+class TestDependencies(object):
+    @pytest.fixture()
+    def nb(self):
+        nb = Nodebook(PickleDict())
+        cells = [
+            ('a', "x = 1\ny = 1"),
+            ('b', "u = x + 1"),
+            ('c', "v = u + 1"),
+            ('d', "w = y + 1"),
+        ]
+        parent = None
+        for node_id, code in cells:
+            nb.insert_node_after(node_id, parent)
+            nb.update_code(node_id, code)
+            nb.run_node(node_id)
+            parent = node_id
+        return nb
+
+    def test_dependents(self, nb):
+        assert nb.dependents('a') == ['b', 'c', 'd']
+        assert nb.dependents('b') == ['c']
+        assert nb.dependents('d') == []
+        assert nb.dependencies('c') == {'u': 'b'}
+
+    def test_targeted_invalidation(self, nb):
+        nb.update_code('a', "x = 2\ny = 1")
+        nb.run_node('a')
+        assert [nb.nodes[n].valid for n in 'abcd'] == [True, False, False, True]
+
+    def test_shadowed_output(self, nb):
+        nb.insert_node_after('e', 'd')
+        nb.update_code('e', "x = 5")
+        nb.run_node('e')
+        nb.insert_node_after('f', 'e')
+        nb.update_code('f', "x")
+        nb.run_node('f')
+        nb.update_code('a', "x = 2\ny = 1")
+        nb.run_node('a')
+        # f reads x from e, so the change in a doesn't reach it
+        assert nb.nodes['f'].valid
+
+    def test_new_output_shadows(self, nb):
+        nb.insert_node_after('e', 'd')
+        nb.update_code('e', "z = x")
+        nb.run_node('e')
+        assert nb.dependencies('e') == {'x': 'a'}
+
+        # d now outputs x too, so e has to read it from d instead
+        nb.update_code('d', "w = y + 1\nx = 10")
+        nb.run_node('d')
+        assert nb.nodes['b'].valid
+        assert not nb.nodes['e'].valid
+        nb.run_node('e')
+        assert nb.dependencies('e') == {'x': 'd'}
+        assert nb.dependents('d') == ['e']
+
+    def test_long_stale_chain(self):
+        nb = Nodebook(PickleDict())
+        parent = None
+        for i in range(1200):
+            node_id = 'c%d' % i
+            nb.insert_node_after(node_id, parent)
+            nb.update_code(node_id, "x%d = %s + 1" % (i, 'x%d' % (i - 1) if i else '0'))
+            nb.run_node(node_id)
+            parent = node_id
+        for i in range(1200):
+            nb.update_code('c%d' % i, "x%d = %s + 2" % (i, 'x%d' % (i - 1) if i else '0'))
+        # every producer is stale, but they're re-run without recursing through each other
+        nb.run_node('c1199')
+        assert nb.variables[nb.nodes['c1199'].outputs['x1199']] == 2400
+        assert all(node.valid for node in nb.nodes.values())
+
+    def test_rebuilt_after_reindex(self, nb):
+        consumers = nb.consumers
+        nb.reindex()
+        assert nb.consumers == consumers
+        assert nb.dependents('a') == ['b', 'c', 'd']
+
+
+class TestRunStale(object):
+    @pytest.fixture(params=['memory', 'disk'])
+    def nb(self, request, tmpdir):
+        nb = Nodebook(PickleDict(str(tmpdir) if request.param == 'disk' else None))
+        cells = [
+            ('a', "x = 1"),
+            ('b', "u = x + 1"),
+            ('c', "v = x * 10"),
+            ('d', "w = u + v"),
+            ('e', "y = 5"),
+        ]
+        parent = None
+        for node_id, code in cells:
+            nb.insert_node_after(node_id, parent)
+            nb.update_code(node_id, code)
+            nb.run_node(node_id)
+            parent = node_id
+        nb.update_code('a', "x = 2")
+        nb.update_code('e', "y = 6")
+        return nb
+
+    def value(self, nb, node_id, var):
+        return nb.variables[nb.nodes[node_id].outputs[var]]
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_all(self, nb, workers):
+        ran = nb.run_stale(workers=workers)
+        assert sorted(ran) == ['a', 'b', 'c', 'd', 'e']
+        assert ran.index('a') < ran.index('b') < ran.index('d')
+        assert all(node.valid for node in nb.nodes.values())
+        assert self.value(nb, 'd', 'w') == 23
+        assert self.value(nb, 'e', 'y') == 6
+        assert nb.dependencies('d') == {'u': 'b', 'v': 'c'}
+        assert nb.stats['d']['hashed'] == 1
+
+    def test_target(self, nb):
+        # b reads x so could mutate it before c, but d and e can't affect c
+        assert nb.run_stale(target='c', workers=2) == ['a', 'b', 'c']
+        assert not nb.nodes['d'].valid
+        assert not nb.nodes['e'].valid
+        assert self.value(nb, 'c', 'v') == 20
+
+    def test_new_output_reruns(self, nb):
+        nb.run_stale(workers=2)
+        # b now shadows x for c, so c's concurrent run must be redone
+        nb.update_code('b', "u = x + 1\nx = 100")
+        nb.update_code('c', "v = x * 10")
+        nb.run_stale(workers=2)
+        assert self.value(nb, 'c', 'v') == 1000
+
+    def test_mutation_reruns(self, nb):
+        nb.run_stale(workers=2)
+        nb.insert_node_after('f', 'c')
+        nb.update_code('f', "z = [x]")
+        nb.run_node('f')
+        nb.insert_node_after('g', 'f')
+        nb.update_code('g', "n = len(z)")
+        nb.insert_node_after('h', 'g')
+        nb.update_code('h', "z.append(1)")
+        nb.insert_node_after('i', 'h')
+        nb.update_code('i', "m = len(z)")
+        # g, h and i run together, but i read z before h mutated it
+        nb.run_stale(workers=3)
+        assert self.value(nb, 'g', 'n') == 1
+        assert self.value(nb, 'i', 'm') == 2
+        assert nb.dependencies('i') == {'z': 'h'}
+
+    def test_error(self, nb):
+        nb.update_code('c', "v = undefined_thing")
+        with pytest.raises(KeyError):
+            nb.run_stale(workers=2)
+
+
+class TestMemoize(object):
+    @pytest.fixture()
+    def nb(self):
+        nb = Nodebook(PickleDict(), memoize=True)
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = [1, 2]")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "calls = [0]\ny = x + [3]\ny")
+        nb.run_node('222')
+        return nb
+
+    def test_hit(self, nb):
+        memo = dict(nb.memo)
+        # formatting and comments don't matter
+        nb.update_code('222', "calls = [0]  # count\ny = x+[3]\ny")
+        res, objs = nb.run_node('222')
+        assert res == [1, 2, 3]
+        assert objs == {'calls': [0], 'y': [1, 2, 3]}
+        assert nb.nodes['222'].valid
+        assert dict(nb.memo) == memo
+
+    def test_miss_on_new_inputs(self, nb):
+        nb.update_code('111', "x = [5]")
+        nb.run_node('111')
+        assert not nb.nodes['222'].valid
+        res, objs = nb.run_node('222')
+        assert res == [5, 3]
+        assert len(nb.memo) == 4
+
+        # back to the original input
+        nb.update_code('111', "x = [1, 2]")
+        nb.run_node('111')
+        res, objs = nb.run_node('222')
+        assert res == [1, 2, 3]
+        assert len(nb.memo) == 4
+
+    def test_memo_holds_refs(self, nb):
+        y_hash = nb.nodes['222'].outputs['y']
+        nb.update_code('222', "y = 1")
+        nb.run_node('222')
+        assert y_hash in nb.variables
+        nb.update_code('222', "calls = [0]\ny = x + [3]\ny")
+        res, objs = nb.run_node('222')
+        assert nb.nodes['222'].outputs['y'] == y_hash
+
+    def test_run_stale(self, nb):
+        nb.insert_node_after('333', '111')
+        nb.update_code('333', "z = x + [4]")
+        nb.update_code('111', "x = [5]")
+        nb.run_stale(workers=2)
+        memo = list(nb.memo)
+        nb.update_code('111', "x = [1, 2]")
+        nb.run_stale(workers=2)
+        nb.update_code('111', "x = [5]")
+        nb.run_stale(workers=2)
+        # the parallel runs were remembered and then restored
+        assert len(nb.memo) == len(memo) + 1
+        assert nb.variables[nb.nodes['333'].outputs['z']] == [5, 4]
+
+    def test_eviction(self, nb):
+        nb.memo_size = 2
+        y_hash = nb.nodes['222'].outputs['y']
+        nb.update_code('222', "y = 1")
+        nb.run_node('222')
+        nb.update_code('222', "y = 2")
+        nb.run_node('222')
+        assert len(nb.memo) == 2
+        assert y_hash not in nb.variables
+        assert set(nb.refcount) == set(nb.variables.keys())
+
+
+class TestObjectCache(object):
+    @pytest.fixture()
+    def nb(self):
+        nb = Nodebook(PickleDict())
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = [1, 2, 3]\ny = [1, 2, 3]")
+        nb.run_node('111')
+        return nb
+
+    def test_rerun_hits_cache(self, nb):
+        # inputs are only kept when the run re-hashes them, proving them unchanged
+        nb.strict = True
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "len(x)")
+        nb.run_node('222')
+        assert nb.cache.stats()['misses'] == 1
+        res, objs = nb.run_node('222')
+        assert res == 3
+        assert nb.cache.stats()['hits'] == 1
+
+    def test_unhashed_inputs_discarded(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "len(x)")
+        nb.run_node('222')
+        assert len(nb.cache) == 0
+
+    def test_unchanged_arrays_kept(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "import numpy as np\nimport pandas as pd\narr = np.arange(10)\ndf = pd.DataFrame({'a': arr})")
+        nb.run_node('222')
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "total = arr.sum() + df['a'].sum()")
+        nb.run_node('333')
+        nb.run_node('333')
+        assert nb.cache.stats()['hits'] == 2
+
+        # modified in a way the analysis misses, then caught by the buffer check
+        nb.update_code('333', "fill = arr.fill\nfill(0)\narr")
+        res, objs = nb.run_node('333')
+        assert res.sum() == 0
+        nb.update_code('333', "arr.sum()")
+        assert nb.run_node('333')[0] == 45
+
+    def test_missed_mutation_is_isolated(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "import operator\noperator.setitem(x, 0, 99)")
+        nb.run_node('222')
+        # an alias of a bound method isn't seen to modify x
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "add = y.append\nadd(4)")
+        nb.run_node('333')
+
+        nb.insert_node_after('444', '333')
+        nb.update_code('444', "x[0], len(y)")
+        res, objs = nb.run_node('444')
+        nb.cache.clear()
+        assert nb.run_node('444')[0] == res == (99, 3)
+
+    def test_mutation_is_isolated(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "len(x)")
+        nb.run_node('222')
+
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "x.append(4)")
+        res, objs = nb.run_node('333')
+        assert objs == {'x': [1, 2, 3, 4]}
+
+        # the cell above the mutation still sees the original value
+        res, objs = nb.run_node('222')
+        assert res == 3
+
+    def test_shared_value_copies(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "y.append(4)\nx")
+        res, objs = nb.run_node('222')
+        assert res == [1, 2, 3]
+        assert objs == {'y': [1, 2, 3, 4]}
+
+    def test_error_discards(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "x.append(4)\nraise ValueError()")
+        with pytest.raises(ValueError):
+            nb.run_node('222')
+        assert len(nb.cache) == 0
+
+    def test_budget(self):
+        nb = Nodebook(PickleDict(), cache_bytes=0)
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = 42")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "x")
+        nb.run_node('222')
+        assert len(nb.cache) == 0
+
+
+class TestReadonlyInputs(object):
+    @pytest.fixture()
+    def nb(self):
+        nb = Nodebook(PickleDict(), readonly_inputs=True)
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "import numpy as np\nimport pandas as pd\narr = np.arange(5)\ndf = pd.DataFrame({'a': arr})")
+        nb.run_node('111')
+        return nb
+
+    def test_array_view(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "total = arr.sum()\narr")
+        res, objs = nb.run_node('222')
+        assert not res.flags.writeable
+        assert list(objs) == ['total']
+
+        # reading again hands out a view of the same cached array
+        res2, _ = nb.run_node('222')
+        assert np.shares_memory(res, res2)
+
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "arr[0] = 42")
+        with pytest.raises(ValueError):
+            nb.run_node('333')
+
+    def test_frame_mutation_detected(self, nb):
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "df.loc[0, 'a'] = 42")
+        res, objs = nb.run_node('222')
+        assert objs['df']['a'].tolist() == [42, 1, 2, 3, 4]
+
+        # the stored original is untouched
+        nb.insert_node_after('333', '111')
+        nb.update_code('333', "df")
+        res, objs = nb.run_node('333')
+        assert res['a'].tolist() == [0, 1, 2, 3, 4]
+
+
+class TestGarbageCollection(object):
+    @pytest.fixture()
+    def nb(self, tmpdir):
+        nb = Nodebook(PickleDict(str(tmpdir)))
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = list(range(1000))")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "y = [v * 2 for v in x]")
+        nb.run_node('222')
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "z = len(y)")
+        nb.run_node('333')
+        return nb
+
+    def test_gc(self, nb, tmpdir):
+        orphan = nb.variables.put(list(range(500)))
+        tmpdir.join('.abc.tmp').write('partial')
+        report = nb.gc()
+        assert report['values'] == 1
+        assert report['bytes'] > len('partial')
+        assert orphan not in nb.variables
+        assert not tmpdir.join('.abc.tmp').exists()
+        assert nb.gc() == {'values': 0, 'bytes': 0}
+
+    def test_gc_finds_files(self, nb, tmpdir):
+        # e.g. written by a session that crashed before saving its state
+        other = PickleDict(str(tmpdir))
+        other.put([1, 2, 3])
+        assert nb.gc()['values'] == 1
+
+    def test_gc_shared(self, tmpdir):
+        notebooks = []
+        for owner in ('first', 'second'):
+            nb = Nodebook(pickledict.SharedPickleDict(str(tmpdir), owner=owner))
+            nb.insert_node_after('111', None)
+            nb.update_code('111', "x = list(range(%d))" % len(notebooks))
+            nb.run_node('111')
+            notebooks.append(nb)
+        assert notebooks[0].gc() == {'values': 0, 'bytes': 0}
+        assert notebooks[1].variables[notebooks[1].nodes['111'].outputs['x']] == [0]
+
+    def test_quota(self, nb):
+        x_hash = nb.nodes['111'].outputs['x']
+        report = nb.enforce_quota(nb.variables.size(nb.nodes['333'].outputs['z']) + 1)
+        # the oldest outputs go first
+        assert report['nodes'] == ['111', '222']
+        assert x_hash not in nb.variables
+        assert nb.nodes['333'].valid
+
+        # evicted values are recomputed when needed
+        nb.update_code('333', "z = len(y) + 1")
+        res, objs = nb.run_node('333')
+        assert objs == {'z': 1001}
+        assert nb.nodes['111'].valid and nb.nodes['222'].valid
+        assert x_hash in nb.variables
+
+    def test_missing_value_reruns(self, nb):
+        del nb.variables[nb.nodes['222'].outputs['y']]
+        nb.update_code('333', "z = len(y) + 1")
+        res, objs = nb.run_node('333')
+        assert objs == {'z': 1001}
+
+    def test_quota_memo_first(self, nb):
+        nb.memoize = True
+        nb.update_code('333', "z = len(y) + 2")
+        nb.run_node('333')
+        nb.update_code('333', "z = len(y) + 3")
+        nb.run_node('333')
+        old = next(iter(nb.memo))
+        report = nb.enforce_quota(sum(nb.variables.size(k) for k in nb.variables.keys()) - 1)
+        assert report['nodes'] == []
+        assert report['values'] == 1
+        assert old not in nb.memo
+
+
+class TestStats(object):
+    @pytest.fixture(params=['memory', 'disk'])
+    def nb(self, request, tmpdir):
+        nb = Nodebook(PickleDict(str(tmpdir) if request.param == 'disk' else None))
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = list(range(1000))")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        nb.update_code('222', "y = len(x)")
+        nb.run_node('222')
+        return nb
+
+    def test_run(self, nb):
+        stats = nb.stats['111']
+        assert stats['bytes_read'] == 0
+        assert stats['bytes_written'] == nb.variables.size(nb.nodes['111'].outputs['x'])
+        assert stats['hashed'] == 1
+        assert stats['total'] >= stats['run'] + stats['store']
+
+        stats = nb.stats['222']
+        assert stats['bytes_read'] == nb.variables.size(nb.nodes['111'].outputs['x'])
+        assert stats['cache_misses'] == 1
+        # x is only read, so only y is hashed
+        assert stats['hashed'] == 1
+
+        nb.strict = True
+        nb.update_code('222', "y = len(x) + 1")
+        nb.run_node('222')
+        nb.update_code('222', "y = len(x) + 2")
+        nb.run_node('222')
+        assert nb.stats['222']['cache_hits'] == 1
+        assert nb.stats['222']['bytes_read'] == 0
+
+    def test_rerun_profiled_separately(self, nb):
+        nb.update_code('111', "x = list(range(10))")
+        nb.update_code('222', "y = len(x) + 1")
+        first = nb.stats['111']
+        nb.run_node('222')
+        assert nb.stats['111'] is not first
+        assert nb.stats['222']['bytes_written'] == nb.variables.size(nb.nodes['222'].outputs['y'])
+
+    def test_memo_hit(self, nb):
+        nb.memoize = True
+        nb.update_code('222', "y = len(x) + 1")
+        nb.run_node('222')
+        assert not nb.stats['222']['memo_hit']
+        nb.update_code('222', "y = len(x) + 2")
+        nb.run_node('222')
+        nb.update_code('222', "y = len(x) + 1")
+        nb.run_node('222')
+        assert nb.stats['222']['memo_hit']
+        assert nb.stats['222']['run'] == 0
+
+    def test_frame(self, nb):
+        frame = nb.stats_frame()
+        assert list(frame.index) == ['111', '222']
+        assert list(frame['cell']) == ['N_1', 'N_2']
+        assert set(nodebookcore.PHASES).issubset(frame.columns)
+        assert set(nodebookcore.STAT_COUNTERS).issubset(frame.columns)
+
+    def test_payloads(self, nb):
+        payloads = []
+
+        class PayloadManager(object):
+            def write_payload(self, payload, single=False):
+                payloads.append(payload)
+
+        nb.update_all_prompts(PayloadManager())
+        assert [p['source'] for p in payloads] == ['set_prompt', 'set_prompt']
+
+        nb.emit_stats = True
+        nb.update_code('222', "y = len(x) + 1")
+        nb.run_node('222')
+        nb.update_all_prompts(PayloadManager())
+        assert payloads[-1]['source'] == 'node_stats'
+        assert payloads[-1]['cell_id'] == '222'
+        assert payloads[-1]['stats'] is nb.stats['222']
+        nb.update_all_prompts(PayloadManager())
+        assert len(payloads) == 3
+
+
+class TestLazyInputs(object):
+    @pytest.fixture(params=['memory', 'disk'])
+    def nb(self, request, tmpdir):
+        nb = Nodebook(PickleDict(str(tmpdir) if request.param == 'disk' else None), lazy_inputs=True)
+        nb.insert_node_after('111', None)
+        nb.update_code('111', "x = list(range(1000))\ny = 5\nlist = 3")
+        nb.run_node('111')
+        nb.insert_node_after('222', '111')
+        return nb
+
+    def test_untouched_not_loaded(self, nb):
+        nb.update_code('222', "if y > 10:\n    print(x)\nz = y + 1")
+        res, objs = nb.run_node('222')
+        assert objs == {'z': 6}
+        stats = nb.stats['222']
+        assert (stats['loaded'], stats['untouched'], stats['hashed']) == (1, 1, 1)
+        assert stats['bytes_read'] == nb.variables.size(nb.nodes['111'].outputs['y'])
+
+    def test_assign_unloaded(self, nb):
+        nb.update_code('222', "if y > 10:\n    print(x)\nx = 3")
+        nb.run_node('222')
+        assert nb.nodes['222'].outputs['x'] == pickledict.hash(3)
+
+    def test_shadowed_builtin(self, nb):
+        nb.update_code('222', "z = list + len([1])")
+        res, objs = nb.run_node('222')
+        assert objs == {'z': 4}
+
+    def test_function_keeps_inputs(self, nb):
+        nb.update_code('222', "def f(z):\n    return x[z]")
+        nb.run_node('222')
+        assert nb.stats['222']['loaded'] == 1
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "f(10)")
+        res, objs = nb.run_node('333')
+        assert res == 10
+
+    def test_mutation(self, nb):
+        nb.update_code('222', "x.append(1)")
+        nb.run_node('222')
+        assert nb.variables[nb.nodes['222'].outputs['x']][-1] == 1
+
+    def test_run_stale(self, nb):
+        nb.update_code('222', "z = y * 2")
+        nb.insert_node_after('333', '222')
+        nb.update_code('333', "w = y * 3")
+        ran = nb.run_stale(workers=2)
+        assert sorted(ran) == ['222', '333']
+        assert nb.variables[nb.nodes['333'].outputs['w']] == 15
+        assert nb.stats['333']['untouched'] == 0
+        assert nb.stats['333']['loaded'] == 1
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+import pickle
+import pytest
+from nodebook.objectcache import ObjectCache, readonly_view
+from nodebook.pickledict import PickleDict
+
+
+@pytest.fixture()
+def store():
+    store = PickleDict()
+    for i in range(4):
+        store['key%d' % i] = b'x' * 100
+    return store
+
+
+class TestObjectCache(object):
+    def test_hit_miss(self, store):
+        cache = ObjectCache(store)
+        value = cache.get('key0')
+        assert cache.get('key0') is value
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['nbytes'] == store.size('key0')
+
+    def test_get_many(self, store):
+        cache = ObjectCache(store)
+        value = cache.get('key0')
+        values = cache.get_many(['key0', 'key1', 'key2', 'key1'])
+        assert values[0] is value
+        assert values[1] is values[3]
+        assert values[2] == b'x' * 100
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 3
+
+    def test_lru_eviction(self, store):
+        size = store.size('key0')
+        cache = ObjectCache(store, max_bytes=2 * size)
+        cache.get('key0')
+        cache.get('key1')
+        cache.get('key0')  # key1 is now least recently used
+        cache.get('key2')
+        assert 'key0' in cache
+        assert 'key1' not in cache
+        assert cache.stats()['evictions'] == 1
+
+    def test_oversized(self, store):
+        cache = ObjectCache(store, max_bytes=1)
+        cache.get('key0')
+        assert len(cache) == 0
+
+    def test_discard_and_resize(self, store):
+        cache = ObjectCache(store)
+        cache.get('key0')
+        cache.get('key1')
+        cache.discard('key0')
+        assert 'key0' not in cache
+        cache.resize(0)
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+
+    def test_pickle_drops_entries(self, store):
+        cache = ObjectCache(store)
+        cache.get('key0')
+        restored = pickle.loads(pickle.dumps(cache))
+        assert len(restored) == 0
+        assert restored.max_bytes == cache.max_bytes
+
+
+class TestReadonlyView(object):
+    def test_array(self):
+        arr = np.arange(5)
+        view = readonly_view(arr)
+        assert np.shares_memory(arr, view)
+        assert not view.flags.writeable
+        assert arr.flags.writeable
+
+    def test_frame(self):
+        df = pd.DataFrame({'a': np.arange(5), 'b': np.linspace(0, 1, 5)})
+        view = readonly_view(df)
+        assert view.equals(df)
+        assert np.shares_memory(view['b'].to_numpy(), df['b'].to_numpy())
+        try:
+            view.loc[0, 'a'] = 42
+        except ValueError:
+            pass  # read-only arrays without copy-on-write
+        assert df.loc[0, 'a'] == 0
+
+    def test_unsupported(self):
+        assert readonly_view([1, 2]) is None
+        assert readonly_view(np.array([[], {}], dtype=object)) is None
+        assert readonly_view(pd.DataFrame({'a': [[1], [2]]})) is None
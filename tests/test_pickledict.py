@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
+import numpy as np
 import pandas as pd
+import msgpack
+import os
+import pickle
 import pytest
 from nodebook.pickledict import PickleDict
+from nodebook import pickledict
 
 
 @pytest.fixture(params=[None, 'tmpdir'], ids=['mode_memory', 'mode_disk'])
@@ -78,3 +83,518 @@ class TestPickleDict(object):
         assert mydict['test_mut'] == l
         l.append(42)
         assert not mydict['test_mut'] == l
+
+    def test_put(self, mydict):
+        df = pd.DataFrame({'a': [0, 1, 2], 'b': ['foo', 'bar', 'baz']})
+        key = mydict.put(df)
+        assert key == pickledict.hash(df)
+        assert mydict[key].equals(df)
+
+        # storing the same value again reuses the existing entry
+        assert mydict.put(df.copy()) == key
+        assert len(mydict) == 1
+
+    def test_put_distinguishes_types(self, mydict):
+        assert mydict.put((1, 2)) != mydict.put([1, 2])
+        assert len(mydict) == 2
+
+
+@pytest.mark.parametrize('hash_name', sorted(pickledict.HASHERS))
+def test_hash_backends(hash_name):
+    store = PickleDict(hash_name=hash_name)
+    key = store.put({'foo': [1, 2, 3]})
+    assert key == pickledict.hash({'foo': [1, 2, 3]}, hash_name=hash_name)
+    assert key != pickledict.hash({'foo': [1, 2, 4]}, hash_name=hash_name)
+
+
+def test_unknown_hash_backend():
+    with pytest.raises(ValueError):
+        PickleDict(hash_name='nope')
+
+
+def test_legacy_store_keeps_md5():
+    store = PickleDict()
+    del store.hash_name  # as pickled by versions that always used md5
+    restored = pickle.loads(pickle.dumps(store))
+    assert restored.hash_name == 'md5'
+    assert restored.put(42) == pickledict.hash(42, hash_name='md5')
+
+
+class TestStructuralHash(object):
+    @pytest.fixture()
+    def df(self):
+        return pd.DataFrame({
+            'a': [0, 1, 2],
+            'b': ['foo', 'bar', 'baz'],
+            'c': pd.Categorical(['x', 'y', 'x']),
+        }, index=pd.Index([10, 20, 30], name='idx'))
+
+    def test_frame(self, df):
+        key = pickledict.structural_hash(df)
+        assert key is not None
+        assert key == pickledict.hash(df)
+        assert key == pickledict.structural_hash(df.copy())
+
+    def test_frame_changes(self, df):
+        key = pickledict.structural_hash(df)
+        changed = df.copy()
+        changed.iloc[0, 0] = 42
+        assert pickledict.structural_hash(changed) != key
+        assert pickledict.structural_hash(df.rename(columns={'a': 'z'})) != key
+        assert pickledict.structural_hash(df.reset_index()) != key
+        assert pickledict.structural_hash(df.astype({'a': 'float64'})) != key
+
+    def test_series_and_index(self, df):
+        assert pickledict.structural_hash(df['a']) == pickledict.structural_hash(df['a'].copy())
+        assert pickledict.structural_hash(df['a']) != pickledict.structural_hash(df['a'].rename('other'))
+        assert pickledict.structural_hash(df.index) != pickledict.structural_hash(df.index.rename('other'))
+
+    def test_numeric_not_pickled(self, monkeypatch):
+        def dump(*args, **kwargs):
+            raise AssertionError("numeric data was pickled")
+        monkeypatch.setattr(pickledict.cloudpickle, 'dump', dump)
+        # labels are numeric too, as string labels are pickled
+        df = pd.DataFrame({0: np.arange(10), 1: np.ones(10), 2: np.arange(10) > 5,
+                           3: pd.date_range('2020-01-01', periods=10)}, index=pd.Index(np.arange(10) * 2))
+        assert pickledict.structural_hash(df) is not None
+        assert pickledict.structural_hash(pd.Index([1.5, 2.5])) is not None
+        assert pickledict.structural_hash(df[1]) is not None
+
+    def test_ndarray(self):
+        arr = np.arange(12, dtype='float64').reshape(3, 4)
+        assert pickledict.structural_hash(arr) == pickledict.structural_hash(arr.copy())
+        assert pickledict.structural_hash(arr) != pickledict.structural_hash(arr.reshape(4, 3))
+        assert pickledict.structural_hash(arr) != pickledict.structural_hash(arr.astype('int64'))
+        assert pickledict.structural_hash(arr[:, ::2]) == pickledict.structural_hash(arr[:, ::2].copy())
+
+    def test_unsupported(self):
+        assert pickledict.structural_hash([1, 2, 3]) is None
+        assert pickledict.structural_hash(np.array([{}, []], dtype=object)) is None
+
+    def test_put_skips_stored(self, mydict, df):
+        key = mydict.put(df)
+        assert mydict.put(df.copy()) == key
+        assert mydict[key].equals(df)
+
+
+class TestSerializers(object):
+    @pytest.fixture()
+    def diskdict(self, tmpdir):
+        return PickleDict(persist_path=tmpdir.strpath)
+
+    def test_npy(self, diskdict):
+        arr = np.arange(12, dtype='float64').reshape(3, 4)
+        key = diskdict.put(arr)
+        assert diskdict.dict[key].endswith('.npy')
+
+        loaded = diskdict[key]
+        assert type(loaded) is np.ndarray
+        assert pickledict.structural_hash(loaded) == key
+
+        # writes to a loaded array stay private
+        loaded[0, 0] = 42
+        assert diskdict[key][0, 0] == 0
+
+    def test_arrow(self, diskdict):
+        pytest.importorskip('pyarrow')
+        df = pd.DataFrame({'a': [0, 1, 2], 'b': ['foo', 'bar', 'baz'], 'c': [0.5, None, 1.5]},
+                          index=pd.Index(['x', 'y', 'z'], name='idx'))
+        key = diskdict.put(df)
+        assert diskdict.dict[key].endswith('.arrow')
+        assert diskdict[key].equals(df)
+        assert pickledict.structural_hash(diskdict[key]) == key
+
+    def test_arrow_writable(self, diskdict):
+        pytest.importorskip('pyarrow')
+        df = pd.DataFrame({'x': np.arange(5), 'y': np.ones(5), 'c': pd.Categorical(list('aabbc'))})
+        key = diskdict.put(df)
+        assert diskdict.dict[key].endswith('.arrow')
+        loaded = diskdict[key]
+        loaded.loc[0, 'x'] = 5
+        loaded.iloc[0, 1] = 99
+        loaded.loc[1, 'c'] = 'c'
+        assert (loaded.loc[0, 'x'], loaded.loc[0, 'y'], loaded.loc[1, 'c']) == (5, 99, 'c')
+        assert diskdict[key].equals(df)
+
+    def test_arrow_hashes(self, diskdict, monkeypatch):
+        pytest.importorskip('pyarrow')
+        hashed = []
+
+        def hash_frame(df, hasher):
+            hashed.append(df)
+            pickledict._hash_frame(df, hasher)
+        monkeypatch.setitem(pickledict.STRUCTURAL_HASHERS, pd.DataFrame, hash_frame)
+
+        # numeric frames round-trip, so they are only hashed for their key
+        key = diskdict.put(pd.DataFrame({'a': np.arange(10), 'b': np.ones(10)}))
+        assert diskdict.dict[key].endswith('.arrow')
+        assert len(hashed) == 1
+        # others are checked once, by hashing what was written
+        del hashed[:]
+        key = diskdict.put(pd.DataFrame({'a': np.arange(10), 'b': ['x'] * 10}))
+        assert diskdict.dict[key].endswith('.arrow')
+        assert len(hashed) == 2
+
+    def test_fallback(self, diskdict):
+        df = pd.DataFrame({'a': [1, 'foo', None]})
+        key = diskdict.put(df)
+        assert diskdict.dict[key].endswith('.pak')
+        assert diskdict[key].equals(df)
+
+    def test_serializer_for_path(self):
+        assert pickledict.serializer_for_path('abc.npy').name == 'npy'
+        assert pickledict.serializer_for_path('abc.pak') is None
+
+
+class TestCodecs(object):
+    def pak_codec(self, store, key):
+        with open(store.dict[key], 'rb') as f:
+            assert f.read(len(pickledict.PAK_MAGIC)) == pickledict.PAK_MAGIC
+            length, = pickledict.PAK_HEADER_LENGTH.unpack(f.read(pickledict.PAK_HEADER_LENGTH.size))
+            return msgpack.unpackb(f.read(length), raw=False)['codec']
+
+    @pytest.mark.parametrize('codec', sorted(pickledict.CODECS))
+    def test_roundtrip(self, tmpdir, codec):
+        store = PickleDict(persist_path=tmpdir.strpath, codec=codec)
+        value = {'text': 'foo' * 100000, 'numbers': list(range(100000))}
+        memory_store = PickleDict()
+        key = store.put(value)
+        assert key == memory_store.put(value)
+        assert store[key] == value
+        assert self.pak_codec(store, key) == codec
+        if codec != 'none':
+            assert store.size(key) < memory_store.size(key)
+
+    def test_incompressible(self, tmpdir):
+        store = PickleDict(persist_path=tmpdir.strpath, codec='zlib')
+        key = store.put(os.urandom(1024 ** 2))
+        assert self.pak_codec(store, key) == 'none'
+
+    def test_empty_payload(self, tmpdir):
+        store = PickleDict(persist_path=tmpdir.strpath, codec='zlib')
+        store['small'] = None
+        assert store['small'] is None
+
+    def test_legacy_headerless(self, tmpdir):
+        store = PickleDict(persist_path=tmpdir.strpath)
+        path = tmpdir.join('legacy.pak').strpath
+        with open(path, 'wb') as f:
+            f.write(msgpack.packb({'foo': [1, 2, 3]}, use_bin_type=True))
+        store.dict['legacy'] = path
+        assert store['legacy'] == {'foo': [1, 2, 3]}
+
+    def test_unknown_codec(self):
+        with pytest.raises(ValueError):
+            PickleDict(codec='nope')
+
+
+class TestWriteBehind(object):
+    @pytest.fixture()
+    def store(self, tmpdir):
+        return PickleDict(persist_path=tmpdir.strpath, write_behind=True)
+
+    def test_hashed_once(self, store, monkeypatch):
+        hashed = []
+
+        def hash_ndarray(arr, hasher):
+            hashed.append(arr)
+            pickledict._hash_ndarray(arr, hasher)
+        monkeypatch.setitem(pickledict.STRUCTURAL_HASHERS, np.ndarray, hash_ndarray)
+        store.put(np.arange(1000))
+        store.flush()
+        assert len(hashed) == 1
+
+    def test_put_and_read(self, store):
+        df = pd.DataFrame({'a': np.arange(1000)})
+        values = [df, np.arange(10), {'foo': [1, 2, 3]}]
+        keys = [store.put(value) for value in values]
+        assert all(key in store for key in keys)
+        assert len(store) == 3
+
+        # reads wait for the pending write
+        assert store[keys[0]].equals(df)
+        assert store[keys[2]] == {'foo': [1, 2, 3]}
+        store.flush()
+        assert all(os.path.exists(store.dict[key]) for key in keys)
+
+    def test_snapshot(self, store):
+        arr = np.zeros(1000)
+        key = store.put(arr)
+        arr[0] = 42  # later changes can't leak into the pending write
+        assert store[key][0] == 0
+
+    def test_pickle_pending(self, store):
+        key = store.put(np.arange(10))
+        state = pickle.dumps(store)
+        store.flush()
+        restored = pickle.loads(state)
+        assert key in restored
+        assert (restored[key] == np.arange(10)).all()
+
+    def test_error(self, store):
+        def fail():
+            raise IOError('disk full')
+        store.defer(fail)
+        with pytest.raises(IOError):
+            store.flush()
+        store.flush()  # errors are only reported once
+
+
+class TestSharedStore(object):
+    @pytest.fixture()
+    def stores(self, tmpdir):
+        return [pickledict.SharedPickleDict(tmpdir.strpath, owner=owner) for owner in ('first', 'second')]
+
+    def value_files(self, tmpdir):
+        return [name for name in os.listdir(tmpdir.strpath) if not name.startswith('.') and name != 'refs']
+
+    @pytest.mark.parametrize('value', [{'foo': [1, 2, 3]}, np.arange(1000)], ids=['pak', 'npy'])
+    def test_stored_once(self, tmpdir, stores, value):
+        first, second = stores
+        key = first.put(value)
+        written = second.bytes_written
+        assert second.put(value) == key
+        assert second.bytes_written == written
+        assert len(self.value_files(tmpdir)) == 1
+        assert np.all(second[key] == value)
+
+    def test_delete_last_reference(self, tmpdir, stores):
+        first, second = stores
+        key = first.put([1, 2, 3])
+        second.put([1, 2, 3])
+        del first[key]
+        assert key not in first
+        assert second[key] == [1, 2, 3]
+        del second[key]
+        assert self.value_files(tmpdir) == []
+
+    def test_reindex_own_keys(self, tmpdir, stores):
+        first, second = stores
+        key = first.put([1, 2, 3])
+        second.put([4, 5])
+        restored = pickle.loads(pickle.dumps(first))
+        restored.reindex()
+        assert restored.keys() == [key]
+
+    def test_cleanup(self, tmpdir, stores):
+        first, second = stores
+        key = first.put([1, 2, 3])
+        tmpdir.join('.second.abc.tmp').write('partial')
+        tmpdir.join('orphan.pak').write('unreferenced')
+        first.remove_temporary_files()
+        # only its own interrupted writes, as the other store may still be writing
+        assert tmpdir.join('.second.abc.tmp').exists()
+        assert not tmpdir.join('orphan.pak').exists()
+        assert first[key] == [1, 2, 3]
+
+    def test_concurrent(self, tmpdir, stores):
+        from concurrent.futures import ThreadPoolExecutor
+
+        def churn(store):
+            for i in range(50):
+                key = store.put(list(range(100)))
+                assert store[key] == list(range(100))
+                del store[key]
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for future in [pool.submit(churn, store) for store in stores]:
+                future.result()
+        assert self.value_files(tmpdir) == []
+
+
+@pytest.mark.skipif(not pickledict.OUT_OF_BAND, reason="requires pickle protocol 5")
+class TestOutOfBand(object):
+    def value(self):
+        return {'weights': np.arange(100000, dtype=np.float64), 'bias': np.ones(3), 'name': 'model'}
+
+    def test_round_trip(self, mydict):
+        value = self.value()
+        key = mydict.put(value)
+        assert key == pickledict.hash(value)
+        loaded = mydict[key]
+        assert (loaded['weights'] == value['weights']).all()
+        assert loaded['name'] == 'model'
+
+        # loaded buffers are private copies
+        loaded['weights'][0] = 42
+        assert mydict[key]['weights'][0] == 0
+
+    def test_write_behind(self, tmpdir):
+        store = PickleDict(persist_path=tmpdir.strpath, write_behind=True)
+        value = self.value()
+        key = store.put(value)
+        value['weights'][0] = 42  # later changes can't leak into the pending write
+        store.flush()
+        assert store[key]['weights'][0] == 0
+
+    def test_segments(self, tmpdir):
+        store = PickleDict(persist_path=tmpdir.strpath)
+        key = store.put(self.value())
+        with open(store.dict[key], 'rb') as f:
+            data, segments = pickledict._read_pak(f)
+        # only the large buffer is stored out-of-band, uncompressed and aligned
+        assert [len(segment) for segment in segments] == [800000]
+        assert np.frombuffer(segments[0], dtype=np.float64)[-1] == 99999
+        assert store.size(key) >= 800000
+
+    def test_small_buffers_in_band(self):
+        value = {'small': np.arange(10)}
+        data, buffers = pickledict._pack(value)
+        assert buffers == []
+        assert msgpack.unpackb(data, raw=False, ext_hook=lambda code, data: code)['small'] == \
+            pickledict.CLOUDPICKLE_CODE
+
+
+class TestBatch(object):
+    @pytest.fixture(params=[None, 'tmpdir'], ids=['mode_memory', 'mode_disk'])
+    def store(self, request, tmpdir):
+        return PickleDict(persist_path=tmpdir.strpath if request.param else None, batch_workers=4)
+
+    def values(self):
+        frame = pd.DataFrame({'a': np.arange(1000)})
+        return [frame, {'foo': [1, 2]}, np.arange(10), frame, 'bar']
+
+    def test_put_many(self, store):
+        values = self.values()
+        keys = store.put_many(values)
+        assert keys == [pickledict.hash(value) for value in values]
+        assert keys == pickledict.hash_many(values, workers=4)
+        assert keys[0] == keys[3]
+        loaded = store.get_many(keys)
+        assert loaded[0].equals(values[0])
+        assert loaded[1] == {'foo': [1, 2]}
+        assert (loaded[2] == values[2]).all()
+        assert loaded[4] == 'bar'
+        # repeated keys load independent copies
+        assert loaded[0] is not loaded[3]
+
+    def test_set_many(self, store):
+        store.set_many({'a': [1], 'b': [2]})
+        assert store.get_many(['b', 'a']) == [[2], [1]]
+
+    def test_errors(self, store):
+        with pytest.raises(KeyError):
+            store.get_many(['a', 'missing'])
+
+
+class TestSpill(object):
+    @pytest.fixture()
+    def store(self, tmpdir):
+        return PickleDict(memory_bytes=2000000, spill_path=tmpdir.strpath)
+
+    def test_spill_lru(self, store):
+        first = store.put(np.arange(100000, dtype=np.float64))
+        second = store.put(np.arange(100000, dtype=np.int64))
+        store[first]  # second is now the least recently used
+        third = store.put({'x': np.ones(100000)})
+        assert os.path.isdir(store.spill_dir)
+        assert isinstance(store.dict[second], pickledict._Spilled)
+        assert not isinstance(store.dict[first], pickledict._Spilled)
+        assert store.resident_bytes <= store.memory_bytes
+        assert store[second][-1] == 99999
+        assert (store[third]['x'] == 1).all()
+        assert store.size(second) >= 800000
+
+    def test_delete(self, store):
+        keys = [store.put(np.arange(100000) + i) for i in range(3)]
+        paths = [store.dict[key].path for key in keys if isinstance(store.dict[key], pickledict._Spilled)]
+        assert paths
+        for key in keys:
+            del store[key]
+        assert os.listdir(store.spill_dir) == []
+        assert store.resident_bytes == 0
+
+    def test_subset(self, store):
+        keys = [store.put(np.arange(100000) + i) for i in range(3)]
+        subset = pickle.loads(pickle.dumps(store.subset(keys)))
+        assert all((subset[key] == store[key]).all() for key in keys)
+        new_key = subset.put(np.zeros(200000))
+        store.merge(subset.entries([new_key]))
+        assert store[new_key].sum() == 0
+        assert store.resident_bytes <= store.memory_bytes
+
+    def test_merge_deleted_spill(self, store):
+        keys = [store.put(np.arange(100000) + i) for i in range(3)]
+        key = next(key for key in keys if isinstance(store.dict[key], pickledict._Spilled))
+        subset = store.subset([key])
+        subset.put(np.arange(100000) + keys.index(key))
+        del store[key]
+        # the spilled file went with the key, so there's nothing left to adopt
+        store.merge(subset.entries([key]))
+        assert key not in store
+
+
+class TestChunked(object):
+    @pytest.fixture()
+    def store(self, tmpdir):
+        return PickleDict(persist_path=tmpdir.strpath, chunked=True)
+
+    def frame(self):
+        rng = np.random.RandomState(0)
+        return pd.DataFrame({'a': rng.normal(size=100000), 'b': rng.normal(size=100000)})
+
+    def test_chunk_ends(self):
+        data = np.random.RandomState(0).bytes(2 * 1024 ** 2)
+        ends = pickledict._chunk_ends(data)
+        assert ends[-1] == len(data)
+        sizes = np.diff([0] + ends)
+        assert sizes[:-1].min() >= pickledict.CHUNK_MIN_BYTES
+        assert sizes.max() <= pickledict.CHUNK_MAX_BYTES
+        # inserting bytes only changes the chunks around them
+        shifted = pickledict._chunk_ends(data[:1000000] + b'abc' + data[1000000:])
+        assert len(set(ends) & set(end if end <= 1000000 else end - 3 for end in shifted)) >= len(ends) - 3
+        assert pickledict._chunk_ends(b'') == []
+
+    def test_round_trip(self, store):
+        frame = self.frame()
+        key = store.put(frame)
+        assert key == pickledict.hash(frame)
+        assert store.dict[key].endswith('.cdc')
+        assert store[key].equals(frame)
+        assert store.put('small') == pickledict.hash('small')
+        assert store[pickledict.hash('small')] == 'small'
+
+    def test_dedup(self, store):
+        frame = self.frame()
+        first = store.put(frame)
+        written = store.bytes_written
+        frame['c'] = frame['a'] * 2
+        second = store.put(frame)
+        # only the new column is written
+        assert store.bytes_written - written < 0.6 * written
+        stats = store.chunk_stats()
+        assert stats['values'] == 2
+        assert stats['dedup_ratio'] > 1.5
+        assert stats['value_bytes'] == store.size(first) + store.size(second)
+
+        del store[first]
+        assert store[second].equals(frame)
+        del store[second]
+        assert os.listdir(os.path.join(store.persist_path, pickledict.CHUNKS_DIR)) == []
+
+    def test_reload(self, store):
+        key = store.put(self.frame())
+        loaded = pickle.loads(pickle.dumps(store))
+        other = loaded.put(self.frame().head(50000))
+        del loaded[key]
+        assert loaded[other].equals(self.frame().head(50000))
+
+    def test_subset(self, store):
+        first = store.put(self.frame())
+        subset = pickle.loads(pickle.dumps(store.subset([first])))
+        assert subset[first].equals(self.frame())
+        frame = self.frame()
+        frame['c'] = 1.0
+        second = subset.put(frame)
+        # written whole, as chunks only referenced by the copy could be deleted before merging
+        assert not subset.dict[second].endswith('.cdc')
+        store.merge(subset.entries([second]))
+        del store[first]
+        assert store[second].equals(frame)
+
+    def test_orphan_chunks(self, store):
+        key = store.put(self.frame())
+        os.remove(store.dict[key])
+        store.reindex()
+        assert store.remove_temporary_files() > 0
+        assert os.listdir(os.path.join(store.persist_path, pickledict.CHUNKS_DIR)) == []